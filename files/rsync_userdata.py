@@ -1,7 +1,11 @@
 #!/usr/bin/env python3
 """Rsync user data from userdb.internal.
 
-Expects a json-formatted spec on stdin
+Expects a json-formatted spec on stdin, or in the file given with --config.
+
+With --daemon (which needs --config), keeps running and syncs every interval
+seconds, plus a random delay of up to jitter seconds. The spec is re-read before
+every sync. Sending SIGUSR1 triggers a sync right away.
 
 Spec format example:
 
@@ -12,31 +16,191 @@ Spec format example:
       "bootstack-template.internal"
    ],
    "local_overrides" : [],
-   "dist_user" : "sshdist"
+   "dist_user" : "sshdist",
+   "max_parallel" : 4,
+   "snapshot" : true,
+   "ssh_multiplex" : true,
+   "manifest" : true,
+   "publish" : "host",
+   "dedupe" : true,
+   "verify" : true,
+   "interval" : 900,
+   "jitter" : 60,
+   "metrics_file" : "/var/lib/prometheus/node-exporter/rsync_userdata.prom"
 }
 
+max_parallel is optional and defaults to 1, i.e. host_dirs are synced one at a
+time.
+
+snapshot is optional and defaults to false. If set, the staging dir is seeded
+from the current local_dir via hard links (rsync --link-dest), so that only
+changed files are transferred and written.
+
+ssh_multiplex is optional and defaults to false. If set, a single ssh
+ControlMaster connection to userdb.internal is opened for the run and shared by
+all rsyncs, instead of authenticating once per host_dir. Note that sshd limits
+the sessions per connection (MaxSessions, 10 by default), keep max_parallel
+below that.
+
+manifest is optional and defaults to false. If set, a manifest of the published
+files (path, size, mtime and sha256) is kept next to local_dir. Runs start with
+an rsync dry run against the published tree, and exit early without staging or
+swapping anything if neither upstream nor the local overrides changed.
+
+publish is optional and defaults to "tree": all host_dirs are staged, and the
+whole local_dir is swapped once all of them synced successfully. With "host",
+each host_dir is swapped into local_dir on its own as soon as it synced, so a
+failing host_dir does not hold back the others.
+
+dedupe is optional and defaults to false. If set, identical files across all
+host_dirs are stored once in a content-addressed store next to local_dir, and
+hard linked from there into the published tree.
+
+verify is optional and defaults to false. If set, every host_dir must come with
+a SHA256SUMS manifest from upstream, in sha256sum format with paths relative to
+the host_dir. Files are hashed as rsync reports them received, while the rest of
+the host_dir is still being transferred, and checked against the manifest once
+rsync is done. In snapshot mode, the digests of verified files are kept in
+local_dir.digests/<host_dir>.json, and files rsync hard links from the published
+tree are not hashed again. Without those digests, the published host_dir is
+hashed during the transfer as well. Other files rsync didn't report are hashed
+once it is done. A host_dir with mismatched, missing or unlisted files is not
+published. Files replaced by local overrides are not checked.
+
+interval and jitter are optional and only used with --daemon, they default to
+900 and 60 seconds.
+
+metrics_file is optional. If set, metrics about every run are written there in
+the node-exporter textfile collector format.
+
 This file is managed by Juju
 """
 
+import argparse
+import ctypes
+import fcntl
+import hashlib
 import json
+import os
+import pwd
+import random
+import re
 import shutil
+import signal
+import stat
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 from pathlib import Path
-from subprocess import check_call
+from subprocess import CalledProcessError, PIPE, Popen, call, check_call, check_output
 from tempfile import TemporaryDirectory
 
+PUBLISH_MODES = ("tree", "host")
+
+# renameat2(2) arguments
+AT_FDCWD = -100
+RENAME_EXCHANGE = 2
+
+# ioctl(2) request to share the data blocks of a file, see ioctl_ficlone(2)
+FICLONE = 0x40049409
+
+# Idle timeout of the ssh master, in case we die without tearing it down
+SSH_CONTROL_PERSIST = 60
+
+# Defaults for --daemon, in seconds
+DEFAULT_INTERVAL = 900
+DEFAULT_JITTER = 60
+
+# Checksum manifest expected in every upstream host_dir with verify
+VERIFY_MANIFEST = "SHA256SUMS"
+VERIFY_WORKERS = 2
+VERIFY_BATCH_BYTES = 4 << 20
+VERIFY_BATCH_FILES = 256
+CHECKSUM_RE = re.compile(r"^([0-9a-f]{64}) [ *](.+)$")
+# rsync --out-format for received files, logged once a file is complete
+OUT_FORMAT = "%b %n"
+OUT_FORMAT_RE = re.compile(r"^\d+ (.+)$")
+
+METRIC_RE = re.compile(r"^(\w+)(\{.*\})? (\S+)$")
+
+STATS_RE = {
+    "files_transferred": re.compile(r"^Number of regular files transferred: ([\d,]+)"),
+    "bytes_received": re.compile(r"^Total bytes received: ([\d,]+)"),
+}
+
+
+def parse_stats(output):
+    """Parse the output of rsync --stats into a dict of counters."""
+    stats = dict.fromkeys(STATS_RE, 0)
+    for line in output.splitlines():
+        for key, regex in STATS_RE.items():
+            match = regex.match(line)
+            if match:
+                stats[key] = int(match.group(1).replace(",", ""))
+    return stats
+
 
-def rsync_ud(key_file, server_user, remote_dir, local_dir):
-    """Sync the local machine's local_dir with userdb.internal's remote_dir."""
-    check_call(
-        [
-            "rsync",
-            "-q",
-            "-e",
-            "ssh -i {}".format(key_file),
-            "-r",
-            "-p",
-            "--delete",
+@contextmanager
+def ssh_master(key_file, server_user, enabled=True, persist=SSH_CONTROL_PERSIST):
+    """Keep an ssh ControlMaster connection to userdb.internal open.
+
+    Yields the control path to pass to rsync_ud(), or None if multiplexing is
+    not enabled or the master connection could not be established, in which
+    case every rsync authenticates on its own as before. The same happens if
+    the master connection goes away while in use.
+
+    persist is the ssh ControlPersist value, i.e. how long the master stays
+    around without any rsync using it.
+    """
+    if not enabled:
+        yield None
+        return
+    target = "{}@userdb.internal".format(server_user)
+    with TemporaryDirectory() as control_dir:
+        control_path = os.path.join(control_dir, "master")
+        try:
+            check_call(
+                [
+                    "ssh",
+                    "-i",
+                    key_file,
+                    "-M",
+                    "-S",
+                    control_path,
+                    "-o",
+                    "ControlPersist={}".format(persist),
+                    "-o",
+                    "ServerAliveInterval=60",
+                    "-f",
+                    "-N",
+                    target,
+                ]
+            )
+        except CalledProcessError as e:
+            print("Unable to start ssh master, not multiplexing: {}".format(e))
+            yield None
+            return
+        try:
+            yield control_path
+        finally:
+            call(["ssh", "-S", control_path, "-O", "exit", target])
+
+
+def rsync_cmd(key_file, server_user, remote_dir, local_dir, options, control_path):
+    """Return the rsync command to sync local_dir with remote_dir.
+
+    If control_path is given, the connection of the ssh master listening
+    there is reused instead of opening a new one.
+    """
+    ssh_cmd = "ssh -i {}".format(key_file)
+    if control_path:
+        ssh_cmd += " -S {} -o ControlMaster=no".format(control_path)
+    return (
+        ["rsync", "-e", ssh_cmd, "-r", "-p", "--delete"]
+        + list(options)
+        + [
             "{}@userdb.internal:/var/cache/userdir-ldap/hosts/{}".format(
                 server_user, remote_dir
             ),
@@ -45,6 +209,83 @@ def rsync_ud(key_file, server_user, remote_dir, local_dir):
     )
 
 
+def rsync_ud(
+    key_file,
+    server_user,
+    remote_dir,
+    local_dir,
+    options=(),
+    control_path=None,
+    on_file=None,
+):
+    """Sync the local machine's local_dir with userdb.internal's remote_dir.
+
+    If on_file is given, it's called with the path of every received file
+    relative to local_dir as soon as rsync is done with it.
+
+    Returns the transfer stats as parsed by parse_stats().
+    """
+    options = ["--stats"] + list(options)
+    if on_file is None:
+        cmd = rsync_cmd(
+            key_file, server_user, remote_dir, local_dir, options, control_path
+        )
+        return parse_stats(check_output(cmd, universal_newlines=True))
+    options.append("--out-format={}".format(OUT_FORMAT))
+    cmd = rsync_cmd(key_file, server_user, remote_dir, local_dir, options, control_path)
+    output = []
+    with Popen(cmd, stdout=PIPE, universal_newlines=True) as proc:
+        for line in proc.stdout:
+            match = OUT_FORMAT_RE.match(line.rstrip("\n"))
+            if match:
+                on_file(match.group(1))
+            else:
+                output.append(line)
+    if proc.returncode:
+        raise CalledProcessError(proc.returncode, cmd)
+    return parse_stats("".join(output))
+
+
+def rsync_changes(
+    key_file, server_user, remote_dir, local_dir, options=(), control_path=None
+):
+    """Return the changes a sync of local_dir with remote_dir would make.
+
+    This is a dry run, nothing is transferred or written.
+    """
+    cmd = rsync_cmd(
+        key_file,
+        server_user,
+        remote_dir,
+        local_dir,
+        ["--dry-run", "--itemize-changes"] + list(options),
+        control_path,
+    )
+    return check_output(cmd, universal_newlines=True).splitlines()
+
+
+def preserve_times(cfg):
+    """Check whether file times are preserved when syncing.
+
+    Unchanged files are detected via rsync's size and mtime quick check, so
+    file times are needed for snapshots and manifests.
+    """
+    return bool(cfg.get("snapshot") or cfg.get("manifest"))
+
+
+def rsync_options(cfg, host_dir):
+    """Return the rsync options to sync host_dir with, as configured in cfg."""
+    options = []
+    if preserve_times(cfg):
+        # Don't preserve directory times, copying in local overrides changes them
+        options += ["-t", "-O"]
+    # Files from local_overrides replace the upstream ones, don't transfer those
+    for override_dir in cfg.get("local_overrides", []):
+        for fn in Path(override_dir).glob("*"):
+            options.append("--exclude=/{}/{}".format(host_dir, fn.name))
+    return options
+
+
 class RsyncUserdataError(Exception):
     """Error in rsync_userdata."""
 
@@ -63,6 +304,15 @@ def validate(cfg):
         raise RsyncUserdataError(
             "Need a list for host_dirs, got: {}".format(cfg["host_dirs"])
         )
+    max_parallel = cfg.get("max_parallel", 1)
+    if not isinstance(max_parallel, int) or max_parallel < 1:
+        raise RsyncUserdataError(
+            "Need a positive integer for max_parallel, got: {}".format(max_parallel)
+        )
+    if cfg.get("publish", "tree") not in PUBLISH_MODES:
+        raise RsyncUserdataError(
+            "Need one of {} for publish, got: {}".format(PUBLISH_MODES, cfg["publish"])
+        )
 
 
 def switch_dirs(src, dst):
@@ -77,30 +327,893 @@ def switch_dirs(src, dst):
     shutil.rmtree(str(tmppath))
 
 
-def copyfiles(src, dst):
-    """Copy files within src to dst."""
+def exchange_dirs(src, dst):
+    """Atomically exchange the src and dst paths with renameat2(2).
+
+    Raises OSError if the kernel or filesystem doesn't support it, and
+    AttributeError if the C library doesn't provide renameat2().
+    """
+    libc = ctypes.CDLL(None, use_errno=True)
+    if libc.renameat2(
+        AT_FDCWD,
+        os.fsencode(str(src)),
+        AT_FDCWD,
+        os.fsencode(str(dst)),
+        RENAME_EXCHANGE,
+    ):
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno), str(dst))
+
+
+def publish_host(src, dst):
+    """Move the staged host dir src to dst, replacing the published one.
+
+    There is no moment where dst is unavailable if the published dir can be
+    exchanged atomically, otherwise this falls back to switch_dirs().
+    """
+    if not dst.exists():
+        src.replace(dst)
+        return
+    try:
+        exchange_dirs(src, dst)
+    except (AttributeError, OSError) as e:
+        print("Unable to exchange {}, switching: {}".format(dst, e))
+        switch_dirs(src, dst)
+    else:
+        shutil.rmtree(str(src))
+
+
+def remove_stale_hosts(local_dir, host_dirs):
+    """Remove any published host dirs which are not in host_dirs anymore."""
+    for path in local_dir.iterdir():
+        if path.name not in host_dirs:
+            print("Removing stale {}".format(path))
+            if path.is_dir() and not path.is_symlink():
+                shutil.rmtree(str(path))
+            else:
+                path.unlink()
+
+
+def file_digest(path):
+    """Return the sha256 hex digest of the file at path."""
+    digest = hashlib.sha256()
+    with open(str(path), "rb") as fp:
+        for chunk in iter(lambda: fp.read(65536), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def load_checksums(path):
+    """Load a sha256sum style manifest into a dict of paths to hex digests."""
+    checksums = {}
+    with open(str(path)) as fp:
+        for line in fp:
+            match = CHECKSUM_RE.match(line.rstrip("\n"))
+            if not match:
+                raise RsyncUserdataError("Bad line in {}: {}".format(path, line))
+            checksums[os.path.normpath(match.group(2))] = match.group(1)
+    return checksums
+
+
+class Verifier:
+    """Verify a host_dir against its upstream manifest while it's received.
+
+    received() is passed to rsync_ud() as on_file. Received files are hashed
+    in the pool in batches of up to VERIFY_BATCH_BYTES or VERIFY_BATCH_FILES,
+    so hashing overlaps with the transfer without a thread handoff per file.
+    """
+
+    def __init__(self, pool, root, host_dir, link_dest=None, known=None):
+        """Verify root/host_dir, hashing files in the executor pool.
+
+        known maps the inode_key() of files verified before to their digests,
+        those are not hashed again. Without it, the files in link_dest/host_dir,
+        which rsync hard links unchanged files from, are hashed right away, so
+        that hashing them overlaps with the transfer too.
+        """
+        self.pool = pool
+        self.host_path = root / host_dir
+        self.prefix = host_dir + "/"
+        self.known = known or {}
+        self.seen = set()
+        self.batch = []
+        self.batch_bytes = 0
+        # Futures of dicts mapping paths relative to host_dir to their
+        # inode_key() and digest
+        self.pending = []
+        self.linked = None
+        if link_dest is not None and not self.known:
+            self.linked = pool.submit(self.hash_inodes, link_dest / host_dir)
+        # The digests of the verified host_dir by inode_key()
+        self.digests = {}
+
+    @staticmethod
+    def inode_key(st):
+        """Return the key identifying a file's content by its inode."""
+        return "{}:{}:{}:{}".format(st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def hash_inodes(self, path):
+        """Return the digests of the files below path by inode_key()."""
+        digests = {}
+        for dirpath, _dirnames, filenames in os.walk(str(path)):
+            for name in filenames:
+                fn = os.path.join(dirpath, name)
+                try:
+                    st = os.lstat(fn)
+                    if stat.S_ISREG(st.st_mode):
+                        digests[self.inode_key(st)] = file_digest(fn)
+                except FileNotFoundError:
+                    continue
+        return digests
+
+    def hash_files(self, files):
+        """Hash files, a list of paths relative to the host_dir and stats."""
+        return {
+            relpath: (self.inode_key(st), file_digest(self.host_path / relpath))
+            for relpath, st in files
+        }
+
+    def flush(self):
+        """Start hashing the current batch."""
+        if self.batch:
+            self.pending.append(self.pool.submit(self.hash_files, self.batch))
+            self.batch = []
+            self.batch_bytes = 0
+
+    def received(self, name):
+        """Queue the file name, relative to root, rsync received for hashing."""
+        if not name.startswith(self.prefix) or name in self.seen:
+            return
+        relpath = name[len(self.prefix) :]
+        try:
+            st = os.lstat(str(self.host_path / relpath))
+        except FileNotFoundError:
+            # rsync logs a file before renaming it into place, check() hashes
+            # it then
+            return
+        self.seen.add(name)
+        if not stat.S_ISREG(st.st_mode):
+            return
+        self.batch.append((relpath, st))
+        self.batch_bytes += st.st_size
+        if (
+            self.batch_bytes >= VERIFY_BATCH_BYTES
+            or len(self.batch) >= VERIFY_BATCH_FILES
+        ):
+            self.flush()
+
+    def check(self, excluded=()):
+        """Check the host_dir against its manifest once rsync is done.
+
+        Files rsync hard linked from link_dest are looked up in the known
+        digests or those of link_dest, other files rsync didn't report are
+        hashed now. Names in excluded, i.e. the local overrides, are not
+        checked. Raises RsyncUserdataError if the manifest is missing or doesn't
+        match.
+        """
+        try:
+            expected = load_checksums(self.host_path / VERIFY_MANIFEST)
+        except FileNotFoundError:
+            raise RsyncUserdataError(
+                "No {} in {}, not verified".format(VERIFY_MANIFEST, self.host_path.name)
+            )
+        linked = self.linked.result() if self.linked else {}
+        hashed = {}
+        for dirpath, _dirnames, filenames in os.walk(str(self.host_path)):
+            reldir = os.path.relpath(dirpath, str(self.host_path))
+            for name in filenames:
+                relpath = name if reldir == "." else os.path.join(reldir, name)
+                if self.prefix + relpath in self.seen:
+                    continue
+                key = self.inode_key(os.lstat(os.path.join(dirpath, name)))
+                digest = linked.get(key) or self.known.get(key)
+                if digest:
+                    hashed[relpath] = key, digest
+                else:
+                    self.received(self.prefix + relpath)
+        self.flush()
+        for future in self.pending:
+            hashed.update(future.result())
+        actual = {relpath: digest for relpath, (_key, digest) in hashed.items()}
+        for relpath in list(excluded) + [VERIFY_MANIFEST]:
+            expected.pop(relpath, None)
+            actual.pop(relpath, None)
+        problems = {
+            "mismatched": [
+                p for p in actual if p in expected and actual[p] != expected[p]
+            ],
+            "missing": [p for p in expected if p not in actual],
+            "unlisted": [p for p in actual if p not in expected],
+        }
+        if any(problems.values()):
+            raise RsyncUserdataError(
+                "Verification of {} failed: {}".format(
+                    self.host_path.name,
+                    ", ".join(
+                        "{} {}".format(kind, sorted(paths))
+                        for kind, paths in problems.items()
+                        if paths
+                    ),
+                )
+            )
+        self.digests = dict(hashed.values())
+
+
+def digests_path(local_dir, host_dir):
+    """Return the path of the digests kept for host_dir in snapshot mode."""
+    return local_dir.parent / (local_dir.name + ".digests") / (host_dir + ".json")
+
+
+def manifest_path(local_dir):
+    """Return the path of the manifest kept for local_dir."""
+    return local_dir.parent / (local_dir.name + ".manifest.json")
+
+
+def build_manifest(cfg, root, previous=None):
+    """Build a manifest of the files below root.
+
+    Each file's path relative to root is mapped to its size, mtime and sha256.
+    Hashes are taken from the previous manifest for files whose size and mtime
+    did not change.
+    """
+    known = previous["files"] if previous else {}
+    files = {}
+    for dirpath, _dirnames, filenames in os.walk(str(root)):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            relpath = os.path.relpath(path, str(root))
+            st = os.lstat(path)
+            entry = [st.st_size, st.st_mtime_ns]
+            if known.get(relpath, [])[:2] == entry:
+                files[relpath] = known[relpath]
+            else:
+                files[relpath] = entry + [file_digest(path)]
+    return {
+        "host_dirs": sorted(cfg["host_dirs"]),
+        "local_overrides": cfg.get("local_overrides", []),
+        "files": files,
+    }
+
+
+def load_manifest(path):
+    """Load a manifest, returns None if there is no usable one."""
+    try:
+        with path.open() as fp:
+            return json.load(fp)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def write_manifest(path, manifest):
+    """Atomically write a manifest to path."""
+    tmppath = path.parent / (path.name + ".new")
+    with tmppath.open("w") as fp:
+        json.dump(manifest, fp)
+    tmppath.replace(path)
+
+
+def overrides_unchanged(cfg, manifest):
+    """Check whether the local overrides match the published ones."""
+    digests = {}
+    for override_dir in cfg.get("local_overrides", []):
+        for fn in Path(override_dir).glob("*"):
+            digests[fn.name] = file_digest(fn)
+    for host_dir in cfg["host_dirs"]:
+        for name, digest in digests.items():
+            entry = manifest["files"].get("{}/{}".format(host_dir, name))
+            if not entry or entry[2] != digest:
+                return False
+    return True
+
+
+def nothing_changed(cfg, manifest, control_path=None):
+    """Check whether a sync would leave the published local_dir as it is.
+
+    The manifest of the last published run has to match the current spec and
+    local overrides, and an rsync dry run against the published tree must not
+    list any changes.
+    """
+    spec = [sorted(cfg["host_dirs"]), cfg.get("local_overrides", [])]
+    if [manifest["host_dirs"], manifest["local_overrides"]] != spec:
+        return False
+    if not overrides_unchanged(cfg, manifest):
+        return False
+    for host_dir in cfg["host_dirs"]:
+        try:
+            changes = rsync_changes(
+                cfg["key_file"],
+                cfg["dist_user"],
+                host_dir,
+                cfg["local_dir"],
+                rsync_options(cfg, host_dir),
+                control_path,
+            )
+        except CalledProcessError as e:
+            print("Dry run for {} failed: {}".format(host_dir, e))
+            return False
+        if changes:
+            print("Changes upstream for {}: {}".format(host_dir, len(changes)))
+            return False
+    return True
+
+
+class ContentStore:
+    """Content-addressed store for the files of the published tree.
+
+    Every file is stored once per content, mode and owner (and mtime, if file
+    times are preserved, as hard links share those as well), and hard linked
+    from there into the host dirs.
+    """
+
+    def __init__(self, path, times=False):
+        """Open the store at path, creating it if needed."""
+        self.path = path
+        self.times = times
+        self.path.mkdir(mode=0o700, exist_ok=True)
+        # Inodes already in the store, these need neither hashing nor linking
+        self.inodes = set()
+        for dirpath, _dirnames, filenames in os.walk(str(self.path)):
+            for name in filenames:
+                st = os.lstat(os.path.join(dirpath, name))
+                self.inodes.add((st.st_dev, st.st_ino))
+
+    def key(self, path, st):
+        """Return the store key of the file at path."""
+        key = "{}-{:o}-{}".format(
+            file_digest(path), stat.S_IMODE(st.st_mode), st.st_uid
+        )
+        if self.times:
+            key += "-{}".format(st.st_mtime_ns)
+        return key
+
+    def dedupe(self, root):
+        """Replace files below root with hard links into the store.
+
+        Returns the number of files which were replaced by a link.
+        """
+        linked = 0
+        for dirpath, _dirnames, filenames in os.walk(str(root)):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                st = os.lstat(path)
+                if (
+                    not stat.S_ISREG(st.st_mode)
+                    or (st.st_dev, st.st_ino) in self.inodes
+                ):
+                    continue
+                key = self.key(path, st)
+                stored = self.path / key[:2] / key
+                stored.parent.mkdir(exist_ok=True)
+                try:
+                    os.link(path, str(stored))
+                    self.inodes.add((st.st_dev, st.st_ino))
+                except FileExistsError:
+                    tmppath = path + ".dedupe"
+                    os.link(str(stored), tmppath)
+                    os.replace(tmppath, path)
+                    linked += 1
+        return linked
+
+    def gc(self):
+        """Remove stored files which are not linked anymore.
+
+        Returns the number of bytes of all links to stored files, and the number
+        of bytes actually stored.
+        """
+        logical = stored = 0
+        for dirpath, _dirnames, filenames in os.walk(str(self.path)):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                st = os.lstat(path)
+                if st.st_nlink == 1:
+                    os.unlink(path)
+                    continue
+                logical += st.st_size * (st.st_nlink - 1)
+                stored += st.st_size
+        return logical, stored
+
+
+def store_path(local_dir):
+    """Return the path of the content store kept for local_dir."""
+    return local_dir.parent / (local_dir.name + ".store")
+
+
+def chown_paths(root, relpaths, uid):
+    """Make uid the owner of the relpaths below root.
+
+    Unlike chown -R this neither walks nor stats the tree, the caller passes
+    the entries which are new in it. Entries which have gone since are
+    skipped.
+    """
+    for relpath in relpaths:
+        try:
+            os.lchown(os.path.join(str(root), relpath), uid, -1)
+        except FileNotFoundError:
+            pass
+
+
+def clone_file(src, dst):
+    """Copy the contents of src to dst, sharing data blocks where supported."""
+    try:
+        with open(str(src), "rb") as fsrc, open(str(dst), "wb") as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    except OSError:
+        # Not a reflink capable filesystem, or src and dst on different ones
+        shutil.copyfile(str(src), str(dst))
+
+
+def same_file_attrs(src_st, path):
+    """Check whether the file at path matches src_st in size, mtime and mode."""
+    try:
+        st = path.stat()
+    except FileNotFoundError:
+        return False
+    return (st.st_size, st.st_mtime_ns, st.st_mode) == (
+        src_st.st_size,
+        src_st.st_mtime_ns,
+        src_st.st_mode,
+    )
+
+
+def copyfiles(src, dst, reference=None, owner=-1):
+    """Copy files within src to dst.
+
+    Copies keep the mode and mtime of the source and are owned by the uid
+    owner, if given. Files in dst which already match are left alone. Files
+    which match in the reference dir, typically the published copy of dst, are
+    hard linked from there. Only files which changed are actually copied.
+
+    Existing files are replaced rather than overwritten, as in snapshot mode
+    they may be hard links into the published tree.
+
+    Returns the number of files copied.
+    """
+    copied = 0
     for fn in src.glob("*"):
-        shutil.copy(str(fn), str(dst / fn.name))
+        src_st = fn.stat()
+        target = dst / fn.name
+        if same_file_attrs(src_st, target):
+            continue
+        tmppath = dst / (fn.name + ".new")
+        if reference and same_file_attrs(src_st, reference / fn.name):
+            os.link(str(reference / fn.name), str(tmppath))
+        else:
+            clone_file(fn, tmppath)
+            os.lchown(str(tmppath), owner, -1)
+            os.chmod(str(tmppath), stat.S_IMODE(src_st.st_mode))
+            os.utime(str(tmppath), ns=(src_st.st_atime_ns, src_st.st_mtime_ns))
+            copied += 1
+        tmppath.replace(target)
+    return copied
 
 
-def main():
-    """Start here."""
-    cfg = json.load(sys.stdin)
-    validate(cfg)
+def override_names(cfg):
+    """Return the names of the files in the local overrides."""
+    return {
+        fn.name
+        for override_dir in cfg.get("local_overrides", [])
+        for fn in Path(override_dir).glob("*")
+    }
+
+
+def fetch_host(cfg, host_dir, staging_dir, options, control_path=None, on_file=None):
+    """Rsync host_dir into staging_dir, verifying it if configured.
+
+    If on_file is given, it's called with every file rsync reports, as with
+    rsync_ud(). Returns the rsync transfer stats, with verify also the time
+    spent verifying after rsync finished. In snapshot mode, the digests of verified
+    files are kept for the next run, which hard links the unchanged ones.
+    """
+    args = (
+        cfg["key_file"],
+        cfg["dist_user"],
+        host_dir,
+        str(staging_dir),
+        options,
+        control_path,
+    )
+    if not cfg.get("verify"):
+        return rsync_ud(*args, on_file=on_file)
+    link_dest = digests = None
+    if cfg.get("snapshot"):
+        link_dest = Path(cfg["local_dir"])
+        digests = digests_path(link_dest, host_dir)
+    with ThreadPoolExecutor(max_workers=VERIFY_WORKERS) as pool:
+        known = load_manifest(digests) if digests else None
+        verifier = Verifier(pool, staging_dir, host_dir, link_dest, known)
+
+        def received(name):
+            verifier.received(name)
+            if on_file:
+                on_file(name)
+
+        stats = rsync_ud(*args, on_file=received)
+        start = time.monotonic()
+        verifier.check(override_names(cfg))
+    stats["verify_seconds"] = time.monotonic() - start
+    if digests:
+        digests.parent.mkdir(exist_ok=True)
+        write_manifest(digests, verifier.digests)
+    return stats
+
+
+def sync_host(cfg, host_dir, staging_dir, control_path=None, store=None):
+    """Sync a single host_dir into staging_dir and apply the local overrides.
+
+    Only the entries rsync reports and the copied overrides are made owned by
+    dist_user, anything else was hard linked from the published tree and is
+    owned by it already. In the "host" publish mode, the host_dir is published
+    right away.
+
+    Returns the rsync transfer stats, plus the time taken in seconds.
+    """
+    start = time.monotonic()
+    options = rsync_options(cfg, host_dir)
     local_dir = Path(cfg["local_dir"])
+    if cfg.get("snapshot") and local_dir.is_dir():
+        # Hard link unchanged files from the published tree
+        options.append("--link-dest={}".format(local_dir.resolve()))
+    received = []
+    stats = fetch_host(
+        cfg, host_dir, staging_dir, options, control_path, received.append
+    )
+    uid = pwd.getpwnam(cfg["dist_user"]).pw_uid
+    chown_paths(staging_dir, received, uid)
+    stats["overrides_copied"] = 0
+    for override_dir in cfg.get("local_overrides", []):
+        stats["overrides_copied"] += copyfiles(
+            Path(override_dir), staging_dir / host_dir, local_dir / host_dir, uid
+        )
+    if cfg.get("publish") == "host":
+        publish_start = time.monotonic()
+        if store:
+            store.dedupe(staging_dir / host_dir)
+        publish_host(staging_dir / host_dir, local_dir / host_dir)
+        stats["publish_seconds"] = time.monotonic() - publish_start
+    stats["elapsed"] = time.monotonic() - start
+    return stats
+
+
+def sync_hosts(cfg, staging_dir, control_path=None, store=None):
+    """Sync all host_dirs into staging_dir, max_parallel of them at a time.
+
+    Every host_dir is attempted, a failing one does not hold up the others.
+    Returns a dict of the stats of synced host_dirs, and a dict of failed
+    host_dirs and their errors.
+    """
+    results = {}
+    failures = {}
+    with ThreadPoolExecutor(max_workers=cfg.get("max_parallel", 1)) as pool:
+        futures = {
+            pool.submit(
+                sync_host, cfg, host_dir, staging_dir, control_path, store
+            ): host_dir
+            for host_dir in cfg["host_dirs"]
+        }
+        for future in as_completed(futures):
+            host_dir = futures[future]
+            try:
+                results[host_dir] = stats = future.result()
+            except (CalledProcessError, OSError, RsyncUserdataError) as e:
+                print("Failed to sync {}: {}".format(host_dir, e))
+                failures[host_dir] = e
+            else:
+                print(
+                    "Synced {} in {:.2f}s: {} files, {} bytes transferred".format(
+                        host_dir,
+                        stats["elapsed"],
+                        stats["files_transferred"],
+                        stats["bytes_received"],
+                    )
+                )
+    print(
+        "Total: {} files, {} bytes transferred".format(
+            sum(r["files_transferred"] for r in results.values()),
+            sum(r["bytes_received"] for r in results.values()),
+        )
+    )
+    return results, failures
+
+
+def publish_tree(cfg, staging_dir, local_dir, store=None):
+    """Publish all host_dirs in staging_dir by swapping it with local_dir."""
+    os.lchown(str(staging_dir), pwd.getpwnam(cfg["dist_user"]).pw_uid, -1)
+    if store:
+        print("Deduplicated {} files".format(store.dedupe(staging_dir)))
+    switch_dirs(staging_dir, local_dir)
+
+
+def sync(cfg, control_path=None, run=None):
+    """Sync and publish the host_dirs as configured in cfg.
+
+    If a run dict is given, it is filled in with what happened as the sync
+    progresses, for write_metrics(). Its "published" entry lists the
+    host_dirs which are now up to date in local_dir.
+    """
+    run = {} if run is None else run
+    local_dir = Path(cfg["local_dir"])
+    per_host = cfg.get("publish") == "host"
+    if per_host:
+        local_dir.mkdir(mode=0o755, exist_ok=True)
+    manifest = load_manifest(manifest_path(local_dir)) if cfg.get("manifest") else None
+    if manifest and nothing_changed(cfg, manifest, control_path):
+        print("No changes upstream, nothing to do")
+        run["skipped"] = run["success"] = True
+        # The published tree is as current as a sync would make it
+        run["published"] = list(cfg["host_dirs"])
+        return
+    store = None
+    if cfg.get("dedupe"):
+        store = ContentStore(store_path(local_dir), preserve_times(cfg))
     with TemporaryDirectory(dir=str(local_dir.parent)) as staging_dir:
         staging_dir = Path(staging_dir)
         staging_dir.chmod(0o755)
-        host_dirs = cfg["host_dirs"]
-        print("Rsync host_dirs: {}".format(host_dirs))
-        local_overrides = cfg.get("local_overrides", [])
-        print("Copying in local_overrides: {}".format(local_overrides))
-        for host_dir in host_dirs:
-            rsync_ud(cfg["key_file"], cfg["dist_user"], host_dir, str(staging_dir))
-            for override_dir in local_overrides:
-                copyfiles(Path(override_dir), staging_dir / host_dir)
-        check_call(["chown", "-R", cfg["dist_user"], str(staging_dir)])
-        switch_dirs(staging_dir, local_dir)
+        print("Rsync host_dirs: {}".format(cfg["host_dirs"]))
+        print("Copying in local_overrides: {}".format(cfg.get("local_overrides", [])))
+        start = time.monotonic()
+        run["results"], run["failures"] = sync_hosts(
+            cfg, staging_dir, control_path, store
+        )
+        run["stage_seconds"] = time.monotonic() - start
+        if per_host:
+            run["published"] = list(run["results"])
+            remove_stale_hosts(local_dir, cfg["host_dirs"])
+        if run["failures"]:
+            raise RsyncUserdataError(
+                "Failed to sync, not published: {}".format(sorted(run["failures"]))
+            )
+        if not per_host:
+            start = time.monotonic()
+            publish_tree(cfg, staging_dir, local_dir, store)
+            run["publish_seconds"] = time.monotonic() - start
+            run["published"] = list(run["results"])
+    if store:
+        logical, stored = store.gc()
+        print(
+            "Dedupe: {} bytes published, {} bytes stored, ratio {:.2f}".format(
+                logical, stored, logical / stored if stored else 1.0
+            )
+        )
+    if cfg.get("manifest"):
+        write_manifest(
+            manifest_path(local_dir), build_manifest(cfg, local_dir, manifest)
+        )
+    run["success"] = True
+
+
+def read_metrics(path):
+    """Read the samples of a textfile collector file.
+
+    Returns a dict mapping (name, labels) to the value of each sample, or an
+    empty dict if the file doesn't exist.
+    """
+    samples = {}
+    try:
+        with open(path) as fp:
+            for line in fp:
+                match = METRIC_RE.match(line)
+                if match:
+                    samples[match.group(1), match.group(2) or ""] = float(
+                        match.group(3)
+                    )
+    except FileNotFoundError:
+        pass
+    return samples
+
+
+def format_metric(name, metric_type, description, samples):
+    """Format a metric for the textfile collector.
+
+    samples is a list of (labels, value) tuples, labels being a dict.
+    """
+    lines = [
+        "# HELP {} {}".format(name, description),
+        "# TYPE {} {}".format(name, metric_type),
+    ]
+    for labels, value in samples:
+        label_str = ",".join('{}="{}"'.format(k, v) for k, v in sorted(labels.items()))
+        lines.append(
+            "{}{} {}".format(name, "{" + label_str + "}" if label_str else "", value)
+        )
+    return "\n".join(lines) + "\n"
+
+
+def write_metrics(path, cfg, run):
+    """Write metrics about a run for the node-exporter textfile collector.
+
+    Failure counters and last success timestamps are carried over from the
+    previous metrics file. A host_dir's last success only advances once it is
+    published, a synced host_dir held back by another one's failure does not
+    count.
+    """
+    previous = read_metrics(path)
+    now = time.time()
+    success = run.get("success", False)
+    results, failures = run.get("results", {}), run.get("failures", {})
+    published = run.get("published", [])
+
+    def last(name, host_dir=None):
+        labels = '{{host_dir="{}"}}'.format(host_dir) if host_dir else ""
+        return previous.get(("rsync_userdata_" + name, labels), 0)
+
+    def per_host(value):
+        return [({"host_dir": h}, value(h)) for h in sorted(cfg["host_dirs"])]
+
+    def result(key):
+        return per_host(lambda h: results.get(h, {}).get(key, 0))
+
+    metrics = [
+        ("last_run_timestamp_seconds", "gauge", "Time of the last run", now),
+        (
+            "last_success_timestamp_seconds",
+            "gauge",
+            "Time of the last successful run",
+            now if success else last("last_success_timestamp_seconds"),
+        ),
+        (
+            "failures_total",
+            "counter",
+            "Number of failed runs",
+            last("failures_total") + (not success),
+        ),
+        ("duration_seconds", "gauge", "Duration of the last run", now - run["start"]),
+        (
+            "stage_duration_seconds",
+            "gauge",
+            "Time taken to sync all host_dirs into staging",
+            run.get("stage_seconds", 0),
+        ),
+        (
+            "publish_duration_seconds",
+            "gauge",
+            "Time taken to swap the staged tree into place",
+            run.get("publish_seconds", 0),
+        ),
+        (
+            "skipped",
+            "gauge",
+            "Whether the last run found nothing changed upstream",
+            int(run.get("skipped", False)),
+        ),
+        (
+            "host_duration_seconds",
+            "gauge",
+            "Time taken to sync the host_dir",
+            result("elapsed"),
+        ),
+        (
+            "host_publish_duration_seconds",
+            "gauge",
+            "Time taken to swap the host_dir into place",
+            result("publish_seconds"),
+        ),
+        (
+            "host_verify_duration_seconds",
+            "gauge",
+            "Time taken to verify the host_dir after rsync finished",
+            result("verify_seconds"),
+        ),
+        (
+            "host_files_transferred",
+            "gauge",
+            "Number of files transferred for the host_dir",
+            result("files_transferred"),
+        ),
+        (
+            "host_bytes_received",
+            "gauge",
+            "Number of bytes received for the host_dir",
+            result("bytes_received"),
+        ),
+        (
+            "host_last_success_timestamp_seconds",
+            "gauge",
+            "Time of the last successful sync of the host_dir",
+            per_host(
+                lambda h: (
+                    now
+                    if h in published
+                    else last("host_last_success_timestamp_seconds", h)
+                )
+            ),
+        ),
+        (
+            "host_failures_total",
+            "counter",
+            "Number of failed syncs of the host_dir",
+            per_host(lambda h: last("host_failures_total", h) + (h in failures)),
+        ),
+    ]
+    content = "".join(
+        format_metric(
+            "rsync_userdata_" + name,
+            metric_type,
+            description,
+            value if isinstance(value, list) else [({}, value)],
+        )
+        for name, metric_type, description, value in metrics
+    )
+    tmppath = "{}.{}".format(path, os.getpid())
+    with open(tmppath, "w") as fp:
+        fp.write(content)
+    os.chmod(tmppath, 0o644)
+    os.replace(tmppath, path)
+
+
+def run_sync(cfg, control_path=None):
+    """Run sync(), writing metrics about the run if configured."""
+    run = {"start": time.time()}
+    try:
+        sync(cfg, control_path, run)
+    finally:
+        if cfg.get("metrics_file"):
+            try:
+                write_metrics(cfg["metrics_file"], cfg, run)
+            except OSError as e:
+                print("Unable to write metrics: {}".format(e))
+
+
+def load_cfg(path=None):
+    """Load and validate the spec from path, or stdin if no path is given."""
+    if path:
+        with open(path) as fp:
+            cfg = json.load(fp)
+    else:
+        cfg = json.load(sys.stdin)
+    validate(cfg)
+    return cfg
+
+
+def daemon(path):
+    """Sync every interval seconds, or right away when receiving SIGUSR1.
+
+    Failed syncs are reported and retried on the next round. With
+    ssh_multiplex, the ssh master connection is kept open between syncs.
+    """
+    wakeup = threading.Event()
+    signal.signal(signal.SIGUSR1, lambda _signum, _frame: wakeup.set())
+    cfg = load_cfg(path)
+    with ssh_master(
+        cfg["key_file"], cfg["dist_user"], cfg.get("ssh_multiplex", False), "yes"
+    ) as control_path:
+        while True:
+            wakeup.clear()
+            try:
+                cfg = load_cfg(path)
+                run_sync(cfg, control_path)
+            except (RsyncUserdataError, CalledProcessError, OSError, ValueError) as e:
+                print("Sync failed: {}".format(e))
+            delay = cfg.get("interval", DEFAULT_INTERVAL) + random.uniform(
+                0, cfg.get("jitter", DEFAULT_JITTER)
+            )
+            if wakeup.wait(delay):
+                print("Sync triggered")
+
+
+def parse_args(argv=None):
+    """Parse the command line arguments."""
+    parser = argparse.ArgumentParser(description="Rsync user data from userdb.internal")
+    parser.add_argument("--config", help="read the spec from this file, not stdin")
+    parser.add_argument(
+        "--daemon", action="store_true", help="keep running, syncing periodically"
+    )
+    args = parser.parse_args(argv)
+    if args.daemon and not args.config:
+        parser.error("--daemon needs --config")
+    return args
+
+
+def main(argv=None):
+    """Start here."""
+    args = parse_args(argv)
+    if args.daemon:
+        daemon(args.config)
+        return
+    cfg = load_cfg(args.config)
+    with ssh_master(
+        cfg["key_file"], cfg["dist_user"], cfg.get("ssh_multiplex", False)
+    ) as control_path:
+        run_sync(cfg, control_path)
 
 
 if __name__ == "__main__":
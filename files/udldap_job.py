@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+"""Run a userdir-ldap job, e.g. ud-replicate from cron, and record how it went.
+
+Usage:
+
+    udldap_job.py --name ud-replicate [--metrics-dir DIR] [--coalesce] \
+        [--backoff SECONDS] -- /usr/bin/ud-replicate
+
+Runs of the job with the same name don't overlap: if a run is still in
+progress, the new one is skipped. With --coalesce, a single further run waits
+for it to finish instead, any other run requested meanwhile is covered by the
+waiting one and is skipped.
+
+With --backoff, runs are skipped after consecutive failures until
+SECONDS * 2^(failures - 1), at most --max-backoff seconds, have passed since
+the last run started, give or take a tenth of SECONDS. With SECONDS being the
+interval the job runs at, it's retried after 1, 2, 4... intervals.
+
+The outcome of the last run is kept in STATE_DIR/udldap_job_<name>.state,
+while a run is in progress its "running" entry holds the pid of this process.
+Skipped runs are logged to syslog. With --metrics-dir, metrics about every
+run are written to DIR/udldap_job_<name>.prom in the node-exporter textfile
+collector format.
+
+Exits with the exit code of the job, or 0 if it was skipped.
+
+This file is managed by Juju
+"""
+
+import argparse
+import contextlib
+import fcntl
+import json
+import os
+import re
+import subprocess
+import sys
+import syslog
+import time
+
+LOCK_DIR = "/run/lock"
+STATE_DIR = "/var/lib/misc"
+MAX_BACKOFF = 3600
+# Runs starting up to this share of --backoff early are backed off already,
+# so that a retry one interval later isn't skipped by a few milliseconds
+BACKOFF_SLACK = 0.1
+METRIC_RE = re.compile(r"^(\w+)(\{.*\})? (\S+)$")
+METRICS = {
+    "udldap_job_last_run_timestamp_seconds": ("gauge", "Time of the last run"),
+    "udldap_job_last_success_timestamp_seconds": (
+        "gauge",
+        "Time of the last successful run",
+    ),
+    "udldap_job_failures_total": ("counter", "Number of failed runs"),
+    "udldap_job_duration_seconds": ("gauge", "Duration of the last run"),
+    "udldap_job_exit_code": ("gauge", "Exit code of the last run"),
+    "udldap_job_skipped_total": ("counter", "Number of skipped runs by reason"),
+}
+
+
+def read_metrics(path):
+    """Read the samples of a textfile collector file.
+
+    Returns a dict mapping (name, labels) to the value of each sample, or an
+    empty dict if the file doesn't exist.
+    """
+    samples = {}
+    try:
+        with open(path) as fp:
+            for line in fp:
+                match = METRIC_RE.match(line)
+                if match:
+                    samples[match.group(1), match.group(2) or ""] = float(
+                        match.group(3)
+                    )
+    except FileNotFoundError:
+        pass
+    return samples
+
+
+def write_atomic(path, content):
+    """Replace the file at path with content."""
+    tmppath = "{}.{}".format(path, os.getpid())
+    with open(tmppath, "w") as fp:
+        fp.write(content)
+    os.chmod(tmppath, 0o644)
+    os.replace(tmppath, path)
+
+
+def write_metrics(path, samples):
+    """Write metrics for the node-exporter textfile collector.
+
+    samples maps (name, labels) to values like read_metrics() returns, the
+    samples of the previous metrics file are carried over unless replaced.
+    """
+    merged = read_metrics(path)
+    merged.update(samples)
+    lines = []
+    for name, (metric_type, description) in METRICS.items():
+        labels = sorted(key[1] for key in merged if key[0] == name)
+        if labels:
+            lines.append("# HELP {} {}".format(name, description))
+            lines.append("# TYPE {} {}".format(name, metric_type))
+            lines.extend(
+                "{}{} {}".format(name, label, merged[name, label]) for label in labels
+            )
+    write_atomic(path, "".join(line + "\n" for line in lines))
+
+
+def run_samples(previous, name, start, returncode):
+    """Return the metric samples for a run of the named job."""
+    labels = '{{job="{}"}}'.format(name)
+    now = time.time()
+    failures = previous.get(("udldap_job_failures_total", labels), 0)
+    samples = {
+        ("udldap_job_last_run_timestamp_seconds", labels): now,
+        ("udldap_job_duration_seconds", labels): now - start,
+        ("udldap_job_exit_code", labels): returncode,
+        ("udldap_job_failures_total", labels): failures + (returncode != 0),
+    }
+    if returncode == 0:
+        samples["udldap_job_last_success_timestamp_seconds", labels] = now
+    elif ("udldap_job_last_success_timestamp_seconds", labels) not in previous:
+        samples["udldap_job_last_success_timestamp_seconds", labels] = 0
+    return samples
+
+
+def skip_samples(previous, name, reason):
+    """Return the metric samples for a skipped run of the named job."""
+    key = ("udldap_job_skipped_total", '{{job="{}",reason="{}"}}'.format(name, reason))
+    return {key: previous.get(key, 0) + 1}
+
+
+def update_metrics(args, samples_func, *func_args):
+    """Update the metrics of the job if --metrics-dir was given."""
+    if not args.metrics_dir:
+        return
+    path = os.path.join(args.metrics_dir, "udldap_job_{}.prom".format(args.name))
+    try:
+        write_metrics(path, samples_func(read_metrics(path), args.name, *func_args))
+    except OSError as e:
+        print("Unable to write metrics: {}".format(e), file=sys.stderr)
+
+
+def read_state(path):
+    """Return the state kept about the job, an empty dict if there's none."""
+    try:
+        with open(path) as fp:
+            return json.load(fp)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def backoff_remaining(state, backoff, max_backoff, now=None):
+    """Return the seconds to back off for after the failures in state."""
+    failures = state.get("failures", 0)
+    if not (backoff and failures):
+        return 0
+    delay = min(backoff * 2 ** (failures - 1), max_backoff) - backoff * BACKOFF_SLACK
+    return max(0, state.get("last_run", 0) + delay - (now or time.time()))
+
+
+@contextlib.contextmanager
+def job_lock(lock_dir, name, coalesce=False):
+    """Take the lock of the named job.
+
+    Yields None once this process may run the job, or why it should skip it:
+    "running" if another run holds the lock. With coalesce this process waits
+    for the lock instead, unless another process is already waiting, then it
+    yields "queued".
+    """
+    base = os.path.join(lock_dir, "udldap_job_{}".format(name))
+    with open(base + ".queue", "a") as queue, open(base + ".lock", "a") as lock:
+        try:
+            fcntl.flock(queue if coalesce else lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield "queued" if coalesce else "running"
+            return
+        if coalesce:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            fcntl.flock(queue, fcntl.LOCK_UN)
+        yield None
+
+
+def skip(args, reason):
+    """Record that the job was skipped and why."""
+    syslog.syslog("udldap_job {}: skipped, {}".format(args.name, reason))
+    update_metrics(args, skip_samples, reason)
+
+
+def run_job(args, state_path):
+    """Run the job unless backing off, returns its exit code."""
+    state = read_state(state_path)
+    if backoff_remaining(state, args.backoff, args.max_backoff):
+        skip(args, "backoff")
+        state.update(skipped="backoff", last_skip=time.time())
+        write_atomic(state_path, json.dumps(state))
+        return 0
+    start = time.time()
+    # Lets others tell the job is running without probing its lock
+    state["running"] = os.getpid()
+    write_atomic(state_path, json.dumps(state))
+    returncode = subprocess.call(args.command)
+    state.update(
+        last_run=start,
+        duration=time.time() - start,
+        returncode=returncode,
+        failures=state.get("failures", 0) + 1 if returncode else 0,
+        skipped=None,
+        running=None,
+    )
+    if not returncode:
+        state["last_success"] = time.time()
+    write_atomic(state_path, json.dumps(state))
+    update_metrics(args, run_samples, start, returncode)
+    return returncode
+
+
+def parse_args(argv=None):
+    """Parse the command line arguments."""
+    parser = argparse.ArgumentParser(description="Run a userdir-ldap job")
+    parser.add_argument("--name", required=True, help="name of the job")
+    parser.add_argument("--metrics-dir", help="write textfile metrics here")
+    parser.add_argument(
+        "--coalesce", action="store_true", help="coalesce overlapping runs"
+    )
+    parser.add_argument(
+        "--backoff", type=int, default=0, help="back off after failures, seconds"
+    )
+    parser.add_argument(
+        "--max-backoff", type=int, default=MAX_BACKOFF, help="longest backoff"
+    )
+    parser.add_argument("--lock-dir", default=LOCK_DIR, help="lock files go here")
+    parser.add_argument("--state-dir", default=STATE_DIR, help="state files go here")
+    parser.add_argument("command", nargs=argparse.REMAINDER, help="job to run")
+    args = parser.parse_args(argv)
+    if args.command[:1] == ["--"]:
+        args.command = args.command[1:]
+    if not args.command:
+        parser.error("need a command to run")
+    return args
+
+
+def main(argv=None):
+    """Start here."""
+    args = parse_args(argv)
+    state_path = os.path.join(args.state_dir, "udldap_job_{}.state".format(args.name))
+    with job_lock(args.lock_dir, args.name, args.coalesce) as reason:
+        if reason:
+            skip(args, reason)
+            return 0
+        return run_job(args, state_path)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
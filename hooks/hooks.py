@@ -1,9 +1,6 @@
 #!/usr/bin/env python3
 """Charm hooks implementation file."""
 import os
-import pwd
-import shutil
-import subprocess
 import sys
 
 from charmhelpers.core import unitdata
@@ -13,14 +10,18 @@ from charmhelpers.core.hookenv import (
     config,
     ingress_address,
     iter_units_for_relation_name,
+    local_unit,
     log,
     open_port,
-    related_units,
     relation_get,
-    relation_ids,
     relation_set,
 )
-from charmhelpers.core.host import mkdir, service_reload
+from charmhelpers.core.host import (
+    mkdir,
+    service_pause,
+    service_restart,
+    service_resume,
+)
 from charmhelpers.fetch import apt_install, configure_sources
 
 import utils
@@ -31,54 +32,77 @@ hook_dir = os.path.abspath(os.path.dirname(__file__))
 charm_dir = os.path.dirname(hook_dir)
 
 
-def setup_udldap():
-    """Install and set up userdir-ldap and dependencies.
-
-    This also sets up a number of configuration files for related apps, sets up a
-    replication cron job, and performs an initial sync, among other things.
-
-    """
-    log("setup_udldap, config: {}".format(config()), level=DEBUG)
-    # The postinst for apt/userdir-ldap needs a working `hostname -f`
-    userdb_ip = utils.determine_userdb_ip()
-    utils.update_hosts(config("userdb-host"), userdb_ip)
+def install_packages():
+    """Install userdir-ldap and the packages it needs."""
     configure_sources(True, "apt-repo-spec", "apt-repo-keys")
     # Need to install/update openssh-server from *-cat for pam_mkhomedir.so.
     apt_install("hostname libnss-db openssh-server userdir-ldap".split())
-    utils.copy_files(charm_dir)
 
-    # If we don't assert these symlinks in /etc, ud-replicate
-    # will write to them for us and trip up the local changes check.
-    if not os.path.islink("/etc/ssh/ssh-rsa-shadow"):
-        os.symlink("/var/lib/misc/ssh-rsa-shadow", "/etc/ssh/ssh-rsa-shadow")
-    if not os.path.islink("/etc/ssh/ssh_known_hosts"):
-        os.symlink("/var/lib/misc/ssh_known_hosts", "/etc/ssh/ssh_known_hosts")
 
-    utils.handle_local_ssh_keys(config("root-id-rsa"))
+def setup_nscd():
+    """Set up nscd to cache passwd and group lookups, or stop it if disabled.
 
+    Only an nscd this charm enabled is stopped, one set up otherwise is left
+    alone.
+    """
+    db = unitdata.kv()
+    if config("nscd"):
+        apt_install(["nscd"])
+        if utils.write_nscd_conf(config("nscd-ttl")):
+            service_restart("nscd")
+        service_resume("nscd")
+        db.set("nscd.enabled", True)
+    elif db.get("nscd.enabled"):
+        service_pause("nscd")
+        db.unset("nscd.enabled")
+
+
+def setup_known_hosts(userdb_ip):
+    """Trust the host key of userdb.internal."""
     # The first run of ud-replicate requires that
     # userdb.internal's host key be trusted.
     seed_known_hosts = config("userdb-known-hosts")
     if seed_known_hosts:
-        with open("/root/.ssh/known_hosts", "a") as f:
-            f.write("%s\n" % str(seed_known_hosts))
+        utils.add_known_hosts(str(seed_known_hosts).splitlines())
     else:
         utils.update_ssh_known_hosts(["userdb.internal", userdb_ip])
 
-    utils.setup_udreplicate_cron()
 
-    # Force initial run
+def initial_replicate():
+    """Run ud-replicate, returns False if that failed or is still running.
+
+    The run continues in the background if it takes long, update-status
+    reports when it is done.
+    """
     # Continue on error (we may just have forgotten to add the host)
-    try:
-        subprocess.check_call(["/usr/bin/ud-replicate"])
-    except subprocess.CalledProcessError:
+    result = utils.start_replicate()
+    if result is None:
+        log("Initial ud-replicate run still in progress")
+        return False
+    if not result:
         log("Initial ud-replicate run failed")
+        return False
+    return True
+
+
+def thishost():
+    """Return what /var/lib/misc/thishost points at, if anything."""
+    try:
+        return os.readlink("/var/lib/misc/thishost")
+    except OSError:
+        return None
 
-    # handle template userdir-ldap hosts
+
+def link_template_host():
+    """Handle template userdir-ldap hosts."""
     template_hostname = config("template-hostname")
     if template_hostname:
-        thishost = os.readlink("/var/lib/misc/thishost")
-        linkdst = os.path.join("/var/lib/misc", thishost)
+        host = thishost()
+        if host is None:
+            # Not replicated yet, try again next time
+            log("setup_udldap: /var/lib/misc/thishost missing")
+            return False
+        linkdst = os.path.join("/var/lib/misc", host)
         if not os.path.lexists(linkdst):
             log("setup_udldap: symlinking {} to {}".format(linkdst, template_hostname))
             os.symlink(template_hostname, linkdst)
@@ -96,14 +120,109 @@ def setup_udldap():
                     "setup_udldap: {} exists but is not a symlink; "
                     "doing nothing".format(linkdst)
                 )
-    # Open the sshd port so we don't have to manually munge secgroups
-    # This is only relevant with ud-ldap since otherwise we can connect via
-    # juju ssh to the unit
-    open_port(22)
 
-    # Add sudoers
-    utils.install_sudoer_group(config("sudoer-group"), config("sudoer-password-groups"))
-    utils.enable_pam_mkhomedir()
+
+def template_host_step():
+    """Return the reconcile() step linking the template host."""
+    return (
+        "template-host",
+        lambda: [config("template-hostname"), thishost()],
+        link_template_host,
+    )
+
+
+def setup_udldap(force=False):
+    """Install and set up userdir-ldap and dependencies.
+
+    This also sets up a number of configuration files for related apps, sets up a
+    replication cron job, and performs an initial sync, among other things.
+
+    Steps whose inputs (config options, charm files etc.) did not change since
+    they last ran are skipped, unless force is set.
+
+    """
+    log("setup_udldap, config: {}".format(config()), level=DEBUG)
+    # The postinst for apt/userdir-ldap needs a working `hostname -f`
+    userdb_ip = utils.determine_userdb_ip()
+    # Only writes /etc/hosts if needed, and restores it if something else did
+    utils.update_hosts(config("userdb-host"), userdb_ip)
+    steps = [
+        (
+            "packages",
+            lambda: [
+                config("apt-repo-spec"),
+                config("apt-repo-keys"),
+                utils.dir_fingerprint(hook_dir),
+            ],
+            install_packages,
+        ),
+        (
+            "files",
+            lambda: utils.dir_fingerprint(os.path.join(charm_dir, "files")),
+            lambda: utils.copy_files(charm_dir),
+        ),
+    ]
+    utils.reconcile(steps, force)
+
+    # If we don't assert these symlinks in /etc, ud-replicate
+    # will write to them for us and trip up the local changes check.
+    if not os.path.islink("/etc/ssh/ssh-rsa-shadow"):
+        os.symlink("/var/lib/misc/ssh-rsa-shadow", "/etc/ssh/ssh-rsa-shadow")
+    if not os.path.islink("/etc/ssh/ssh_known_hosts"):
+        os.symlink("/var/lib/misc/ssh_known_hosts", "/etc/ssh/ssh_known_hosts")
+
+    steps = [
+        (
+            "ssh-keys",
+            lambda: [config("root-id-rsa"), os.path.exists("/root/.ssh/id_rsa")],
+            lambda: utils.handle_local_ssh_keys(config("root-id-rsa")),
+        ),
+        (
+            "known-hosts",
+            [config("userdb-known-hosts"), userdb_ip],
+            lambda: setup_known_hosts(userdb_ip),
+        ),
+        (
+            "nscd",
+            lambda: [
+                config("nscd"),
+                config("nscd-ttl"),
+                utils.dir_fingerprint(os.path.join(charm_dir, "templates")),
+            ],
+            setup_nscd,
+        ),
+        (
+            "udreplicate-cron",
+            [
+                local_unit(),
+                config("metrics-textfile-dir"),
+                config("sync-interval"),
+                config("nscd"),
+            ],
+            utils.setup_udreplicate_cron,
+        ),
+        # Force initial run
+        ("ud-replicate", [userdb_ip], initial_replicate),
+        template_host_step(),
+        # Open the sshd port so we don't have to manually munge secgroups
+        # This is only relevant with ud-ldap since otherwise we can connect via
+        # juju ssh to the unit
+        ("open-port", [], lambda: open_port(22)),
+        # Add sudoers
+        (
+            "sudoers",
+            lambda: [
+                config("sudoer-group"),
+                config("sudoer-password-groups"),
+                utils.dir_fingerprint(os.path.join(charm_dir, "templates")),
+            ],
+            lambda: utils.install_sudoer_group(
+                config("sudoer-group"), config("sudoer-password-groups")
+            ),
+        ),
+        ("pam-mkhomedir", [], utils.enable_pam_mkhomedir),
+    ]
+    utils.reconcile(steps, force)
 
 
 def reconfigure_sshd():
@@ -112,8 +231,10 @@ def reconfigure_sshd():
     Note: this cannot be done before juju is setup (e.g. during MaaS
     install) because of bug #1270896.  Afterwards *should* be safe.
 
+    sshd is reloaded once at the end of the hook, and only if the settings in
+    effect changed.
+
     """
-    sshd_config = "/etc/ssh/sshd_config"
     safe_kex_algos = "".join(config("kex-algorithms").splitlines())
     safe_ciphers = "".join(config("ciphers").splitlines())
     safe_macs = "".join(config("macs").splitlines())
@@ -124,66 +245,44 @@ def reconfigure_sshd():
         "MACs": safe_macs,
     }
     blacklist_host_keys = ["/etc/ssh/ssh_host_dsa_key", "/etc/ssh/ssh_host_ecdsa_key"]
-    found = {}
-    with open(sshd_config, "r") as f, open(sshd_config + ".new", "w") as new:
-        for line in f:
-            lsplit = line.split()
-            if not lsplit or lsplit[0].startswith("#"):
-                new.write(line)
-                continue
-            key = lsplit[0]
-            value = lsplit[1:]
-            if key in conf:
-                found[key] = True
-                if conf[key]:
-                    line = "{} {}\n".format(key, conf[key])
-                else:
-                    line = "#{}".format(line)
-            if key == "HostKey" and value[0] in blacklist_host_keys:
-                line = "#{}".format(line)
-            new.write(line)
-        for k in conf.keys():
-            if k not in found and conf[k]:
-                new.write("{} {}\n".format(k, conf[k]))
-    with open(sshd_config, "r") as f:
-        current = f.read()
-    with open(sshd_config + ".new", "r") as f:
-        new = f.read()
-    if new != current:
-        log("Updating sshd config and reloading sshd")
-        os.rename(sshd_config, sshd_config + ".orig")
-        os.rename(sshd_config + ".new", sshd_config)
-        service_reload("ssh")
-    else:
-        os.unlink(sshd_config + ".new")
+    if unitdata.kv().get("sshd.reload_pending"):
+        utils.schedule_sshd_reload()
+    changed = utils.update_sshd_config(conf, blacklist_host_keys)
+    if changed:
+        log("Updated sshd config, changed: {}".format(", ".join(changed)))
+        utils.schedule_sshd_reload()
 
 
 def copy_user_keys():
     """Copy users authorized_keys from ~/.ssh to our new location."""
-    dst_keydir = "/etc/ssh/user-authorized-keys"
+    dst_keydir = utils.USER_KEYS_DIR
     if not os.path.isdir(dst_keydir):
         os.mkdir(dst_keydir)
         os.chmod(dst_keydir, 0o755)
         os.chown(dst_keydir, 0, 0)
     user_list = str(config("users-to-migrate")).split()
+    result = utils.migrate_user_keys(user_list, dst_keydir)
+    counts = {key: len(users) for key, users in result.items()}
+    log(
+        "Migrated authorized_keys: {migrated} copied, {unchanged} unchanged, "
+        "{missing} missing users, {no_keys} without keys".format(**counts)
+    )
+    for key in ("migrated", "missing", "no_keys"):
+        if result[key]:
+            log("Users {}: {}".format(key, " ".join(result[key])), level=DEBUG)
 
-    for username in user_list:
-        # Skip if the user doesn't exist.
-        try:
-            pwnam = pwd.getpwnam(username)
-        except KeyError:
-            log("User {} does not exist, skipping.".format(username))
-            continue
-
-        src_keyfile = os.path.join(pwnam.pw_dir, ".ssh/authorized_keys")
-        if os.path.isfile(src_keyfile):
-            log("Migrating authorized_keys for {}".format(username))
-            dst_keyfile = "{}/{}".format(dst_keydir, username)
-            shutil.copyfile(src_keyfile, dst_keyfile)
-            os.chmod(dst_keyfile, 0o444)
-            os.chown(dst_keyfile, 0, 0)
-        else:
-            log("No authorized_keys file to migrate for {}".format(username))
+
+def setup_rsync_userdata():
+    """Set up periodic rsync_userdata.py runs, via its service or via cron.
+
+    Returns whether the service was started or restarted.
+    """
+    if config("rsync-userdata-daemon"):
+        return utils.setup_rsync_userdata_service()
+    else:
+        utils.remove_rsync_userdata_service()
+        utils.setup_rsync_userdata_cron()
+    return False
 
 
 @hooks.hook(
@@ -202,6 +301,9 @@ def udconsume_data_rel():
     is could be our actual hostname but typically will be a template
     hostname.
 
+    With several producers, consumers are spread across them and fail over
+    to the next one if their preferred producer is unreachable or slow.
+
     For departing relations, we unset the persisted producer address,
     and re-instate the original userdb.internal user data source
     """
@@ -213,18 +315,23 @@ def udconsume_data_rel():
     if not addresses:
         log("No udconsume rels anymore")
         db.unset("udconsume_upstream")
+        db.unset("udconsume_upstream_latency")
         db.flush()
         utils.update_hosts(config("userdb-host"), config("userdb-ip"))
         utils.update_ssh_known_hosts(["userdb.internal", config("userdb-ip")])
         return
-    userdb_ip = sorted(list(addresses))[0]  # Pick a deterministic address
+    # Pick a deterministic, reachable address
+    userdb_ip, latency = utils.select_upstream(
+        addresses, local_unit(), db.get("udconsume_upstream")
+    )
     log(
-        "udconsume addresses: {}, picking {} for userdb-ip".format(
-            addresses, userdb_ip
+        "udconsume addresses: {}, picking {} for userdb-ip (latency {})".format(
+            addresses, userdb_ip, latency
         ),
         level=DEBUG,
     )
     db.set("udconsume_upstream", userdb_ip)
+    db.set("udconsume_upstream_latency", latency)
     db.flush()
     utils.update_hosts(config("userdb-host"), userdb_ip)
     with open("/root/.ssh/id_rsa.pub") as fp:
@@ -258,32 +365,41 @@ def udprovide_rel():
 
     Iterate through the related consumer/client units, install their
     ssh pubkeys and set up the rsync job for those. Also, kick off an
-    initial sync.
+    initial sync in the background.
+
+    Nothing is done if the set of consumer pubkeys and hosts didn't change.
     """
-    ud_units = set()
     _, fqdn = utils.my_hostnames()
     log("udprovide relation_get: {}".format(relation_get()), level=DEBUG)
-    for rid in relation_ids("udprovide"):
-        for unit in related_units(relid=rid):
-            pub_key = relation_get("pub_key", unit, rid)
-            template_host = relation_get("template_host", unit, rid)
-            host = template_host or fqdn
-            if pub_key and host:
-                ud_units.add((pub_key, host))
+    ud_units = utils.udprovide_units(fqdn)
 
     log("num ud_units: {}".format(len(ud_units)), level=DEBUG)
+    db = unitdata.kv()
+    digest = utils.fingerprint(sorted(ud_units))
+    if db.get("udprovide.ud_units") == digest and os.path.exists(
+        utils.RSYNC_USERDATA_CFG
+    ):
+        log("udprovide: consumers unchanged, nothing to do")
+        return
     utils.ensure_user("sshdist", "/var/lib/misc")
     utils.write_authkeys("sshdist", ud_units)
     mkdir("/var/cache/userdir-ldap/hosts", perms=0o755)
     utils.write_rsync_cfg([h for _k, h in ud_units])
-    utils.run_rsync_userdata()
-    utils.setup_rsync_userdata_cron()
+    started = setup_rsync_userdata()
+    if not config("rsync-userdata-daemon"):
+        utils.queue_rsync_userdata()
+    elif not started:
+        # A freshly started service syncs by itself, and SIGUSR1 would kill it
+        # before it installed its handler
+        utils.trigger_rsync_userdata()
+    db.set("udprovide.ud_units", digest)
+    db.flush()
 
 
 @hooks.hook("install", "install.real")
 def install():
     """Install and setup userdir-ldap and its dependencies."""
-    setup_udldap()
+    setup_udldap(force=True)
     copy_user_keys()
     reconfigure_sshd()
 
@@ -293,6 +409,27 @@ def config_changed():
     """Handle configuration changes."""
     setup_udldap()
     reconfigure_sshd()
+    if os.path.exists(utils.RSYNC_USERDATA_CFG):
+        # This is a userdata producer
+        utils.write_rsync_cfg()
+        setup_rsync_userdata()
+
+
+@hooks.hook("update-status")
+def update_status():
+    """Report how user data replication is doing.
+
+    Once a background ud-replicate run succeeded, the steps setup hooks had to
+    defer until then are completed.
+    """
+    if utils.replicate_succeeded():
+        utils.reconcile(
+            [
+                ("ud-replicate", [utils.determine_userdb_ip()], lambda: True),
+                template_host_step(),
+            ]
+        )
+    utils.report_replicate_status()
 
 
 if __name__ == "__main__":
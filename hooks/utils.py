@@ -1,25 +1,46 @@
 """Utilities module."""
 
-import binascii
+import base64
+import glob
+import hashlib
+import hmac
 import json
 import os
+import pwd
 import re
+import shlex
 import shutil
+import signal
 import socket
 import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 from charmhelpers.core import templating, unitdata
 from charmhelpers.core.hookenv import (
     DEBUG,
+    ERROR,
     WARNING,
+    atexit,
+    cached,
     config,
     local_unit,
     log,
     related_units,
+    relation_get,
     relation_ids,
     status_set,
 )
-from charmhelpers.core.host import adduser, user_exists, write_file
+from charmhelpers.core.host import (
+    adduser,
+    service_pause,
+    service_reload,
+    service_restart,
+    service_resume,
+    service_running,
+    user_exists,
+    write_file,
+)
 
 from python_hosts.hosts import Hosts, HostsEntry
 
@@ -27,6 +48,31 @@ from python_hosts.hosts import Hosts, HostsEntry
 HOSTS_FILE = "/etc/hosts"
 JUJU_SUDOERS_TMPL = "90-juju-userdir-ldap.j2"
 JUJU_SUDOERS = "/etc/sudoers.d/90-juju-userdir-ldap"
+KEYSCAN_TIMEOUT = 5
+NSCD_CONF = "/etc/nscd.conf"
+NSCD_TMPL = "nscd.conf.j2"
+REPLICATE_UNIT = "udldap-replicate"
+REPLICATE_WAIT = 60
+UDLDAP_JOB_STATE = "/var/lib/misc/udldap_job_{}.state"
+UPSTREAM_FAST_LATENCY = 0.2
+UPSTREAM_MAX_LATENCY = 0.5
+UPSTREAM_PROBE_TIMEOUT = 2
+SSHD_CONFIG = "/etc/ssh/sshd_config"
+# sshd keywords that may be given more than once, all others: first one wins
+SSHD_MULTI_KEYWORDS = {
+    "acceptenv",
+    "hostcertificate",
+    "hostkey",
+    "listenaddress",
+    "port",
+    "setenv",
+    "subsystem",
+}
+USER_KEYS_DIR = "/etc/ssh/user-authorized-keys"
+RSYNC_USERDATA_CFG = "/var/lib/misc/rsync_userdata.cfg"
+RSYNC_USERDATA_CRON = "/etc/cron.d/rsync_userdata"
+RSYNC_USERDATA_SERVICE = "rsync-userdata"
+RSYNC_USERDATA_UNIT = "/etc/systemd/system/rsync-userdata.service"
 
 
 class UserdirLdapError(Exception):
@@ -35,12 +81,75 @@ class UserdirLdapError(Exception):
     pass
 
 
+def fingerprint(inputs):
+    """Return a fingerprint of JSON serializable inputs."""
+    return hashlib.sha256(
+        json.dumps(inputs, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+def reconcile(steps, force=False):
+    """Run the steps whose inputs changed since they last ran.
+
+    steps is a list of (name, inputs, func) tuples, run in order. inputs is
+    anything JSON serializable, or a callable returning it which is called
+    right before the step would run. A fingerprint of the inputs is kept in
+    unitdata once func() completed, unless it returned False, and the step is
+    skipped while its inputs keep that fingerprint. With force, all steps run.
+
+    Returns the names of the skipped steps.
+    """
+    db = unitdata.kv()
+    skipped = []
+    for name, inputs, func in steps:
+        key = "reconcile.{}".format(name)
+        current = fingerprint(inputs() if callable(inputs) else inputs)
+        if not force and db.get(key) == current:
+            skipped.append(name)
+            continue
+        log("Running step {}".format(name), level=DEBUG)
+        if func() is not False:
+            db.set(key, current)
+            db.flush()
+    log("Skipped unchanged steps: {}".format(", ".join(skipped) or "none"))
+    return skipped
+
+
+def dir_fingerprint(path):
+    """Return a fingerprint of the contents of the files in path."""
+    digest = hashlib.sha256()
+    for name in sorted(os.listdir(path)):
+        filename = os.path.join(path, name)
+        if os.path.isfile(filename):
+            digest.update(name.encode())
+            with open(filename, "rb") as fp:
+                digest.update(fp.read())
+    return digest.hexdigest()
+
+
 def ensure_user(user, home):
     """Create the user account if it does not already exist."""
     if not user_exists(user):
         adduser(user, home_dir=home, shell="/bin/false")
 
 
+def udprovide_units(fqdn):
+    """Return the (pub_key, host) tuples of the related userdata consumers.
+
+    Consumers not asking for a template host sync the data of fqdn. All
+    relation data of a unit is read with a single relation-get.
+    """
+    ud_units = set()
+    for rid in relation_ids("udprovide"):
+        for unit in related_units(relid=rid):
+            settings = relation_get(unit=unit, rid=rid) or {}
+            pub_key = settings.get("pub_key")
+            host = settings.get("template_host") or fqdn
+            if pub_key and host:
+                ud_units.add((pub_key, host))
+    return ud_units
+
+
 def write_authkeys(username, ud_units):
     """Set up limited access to allow for limited rsync access to this system.
 
@@ -56,12 +165,14 @@ def write_authkeys(username, ud_units):
     write_file(path=auth_file, content=content, owner=username)
 
 
-def write_rsync_cfg(hosts):
+def write_rsync_cfg(hosts=None):
     """Write config json userdata rsync.
 
     The userdata rsync is typically kicked off from cron
     for specific host directories. It persists raw source
     user data (unprocessed, unlike ud-replicate)
+
+    If hosts is None, the host directories already configured are kept.
     """
     base_cfg = {
         "key_file": "/root/.ssh/id_rsa",
@@ -71,21 +182,107 @@ def write_rsync_cfg(hosts):
     }
     try:
         # Load existing config if any
-        fp = open("/var/lib/misc/rsync_userdata.cfg", "r")
+        fp = open(RSYNC_USERDATA_CFG, "r")
         base_cfg.update(json.load(fp))
     except FileNotFoundError:
         pass
-    base_cfg["host_dirs"] = hosts
-    with open("/var/lib/misc/rsync_userdata.cfg", "w") as fp:
+    if hosts is not None:
+        base_cfg["host_dirs"] = hosts
+    base_cfg.setdefault("host_dirs", [])
+    metrics_dir = config("metrics-textfile-dir")
+    if metrics_dir:
+        base_cfg["metrics_file"] = os.path.join(metrics_dir, "rsync_userdata.prom")
+    else:
+        base_cfg.pop("metrics_file", None)
+    base_cfg["interval"] = sync_interval() * 60
+    with open(RSYNC_USERDATA_CFG, "w") as fp:
         json.dump(base_cfg, fp)
 
 
-def run_rsync_userdata():
-    """Run the rsync_userdata.py script."""
-    with open("/var/lib/misc/rsync_userdata.cfg") as fp:
-        subprocess.call(["/usr/local/sbin/rsync_userdata.py"], stdin=fp)
+def queue_rsync_userdata():
+    """Queue a run of the rsync_userdata.py script in a transient systemd unit.
+
+    Runs queued while one is in progress are coalesced into a single one, and
+    cron runs are serialized with them. Output goes to the journal.
+    """
+    cmd = "/usr/local/sbin/rsync_userdata.py --config {}".format(RSYNC_USERDATA_CFG)
+    subprocess.check_call(
+        [
+            "systemd-run",
+            "--description",
+            "Queued rsync_userdata.py run",
+            "--collect",
+            "--quiet",
+        ]
+        + udldap_job_args("rsync_userdata", cmd.split(), coalesce=True)
+    )
+
+
+def setup_rsync_userdata_service():
+    """Install and start the rsync_userdata.py service.
+
+    The service replaces the rsync_userdata.py cron job, it syncs periodically
+    by itself and can be asked to sync right away.
+
+    Returns whether the service was started or restarted. It syncs right
+    away then, and may not be ready for trigger_rsync_userdata() yet.
+    """
+    content = (
+        "# This file is managed by juju\n"
+        "[Unit]\n"
+        "Description=Rsync user data from userdb.internal\n"
+        "Wants=network-online.target\n"
+        "After=network-online.target\n"
+        "\n"
+        "[Service]\n"
+        "ExecStart=/usr/local/sbin/rsync_userdata.py --daemon --config {}\n"
+        "Environment=PYTHONUNBUFFERED=1\n"
+        "Restart=on-failure\n"
+        "RestartSec=30\n"
+        "\n"
+        "[Install]\n"
+        "WantedBy=multi-user.target\n".format(RSYNC_USERDATA_CFG)
+    )
+    try:
+        with open(RSYNC_USERDATA_UNIT) as fp:
+            changed = fp.read() != content
+    except FileNotFoundError:
+        changed = True
+    if changed:
+        write_file(path=RSYNC_USERDATA_UNIT, content=content, perms=0o644)
+        subprocess.check_call(["systemctl", "daemon-reload"])
+    if os.path.exists(RSYNC_USERDATA_CRON):
+        os.unlink(RSYNC_USERDATA_CRON)
+    started = not service_running(RSYNC_USERDATA_SERVICE)
+    service_resume(RSYNC_USERDATA_SERVICE)
+    if changed:
+        service_restart(RSYNC_USERDATA_SERVICE)
+    return started or changed
+
+
+def remove_rsync_userdata_service():
+    """Stop and remove the rsync_userdata.py service, if installed."""
+    if not os.path.exists(RSYNC_USERDATA_UNIT):
+        return
+    service_pause(RSYNC_USERDATA_SERVICE)
+    os.unlink(RSYNC_USERDATA_UNIT)
+    subprocess.check_call(["systemctl", "daemon-reload"])
 
 
+def trigger_rsync_userdata():
+    """Ask the rsync_userdata.py service to sync right away."""
+    pid = subprocess.check_output(
+        ["systemctl", "show", "--property=MainPID", "--value", RSYNC_USERDATA_SERVICE]
+    )
+    pid = int(pid.decode().strip() or 0)
+    if not pid:
+        log("{} is not running, not triggering a sync".format(RSYNC_USERDATA_SERVICE))
+        return
+    # Signal the main process only, the signal would kill running rsyncs
+    os.kill(pid, signal.SIGUSR1)
+
+
+@cached
 def lxc_hostname(hostname):
     """Replace LXD-style names with names based upon the principal app's name.
 
@@ -108,6 +305,34 @@ def lxc_hostname(hostname):
     return hostname, hostname_lxc
 
 
+def lookup_fqdn():
+    """Return socket.getfqdn(), cached in unitdata if identity-cache-ttl is set.
+
+    Only fully qualified names are cached, for identity-cache-ttl seconds and
+    as long as the hostname stays the same.
+    """
+    ttl = config("identity-cache-ttl")
+    if not ttl:
+        return socket.getfqdn()
+    db = unitdata.kv()
+    hostname = os.uname()[1]
+    entry = db.get("identity.fqdn")
+    if (
+        entry
+        and entry["hostname"] == hostname
+        and 0 <= time.time() - entry["time"] < ttl
+    ):
+        return entry["fqdn"]
+    fqdn = socket.getfqdn()
+    if "." in fqdn:
+        db.set(
+            "identity.fqdn", {"hostname": hostname, "fqdn": fqdn, "time": time.time()}
+        )
+        db.flush()
+    return fqdn
+
+
+@cached
 def my_hostnames():
     """Return hostnames and fqdn for the local machine."""
     # We can't rely on socket.getfqdn() and still need to use os.uname() here
@@ -115,7 +340,7 @@ def my_hostnames():
     #   5.0.189.10.in-addr.arpa domain name pointer 10-189-0-5.bos01.scalingstack.
     #   5.0.189.10.in-addr.arpa domain name pointer bagon.bos01.scalingstack.
     hostname = os.uname()[1]
-    dns_fqdn = socket.getfqdn()
+    dns_fqdn = lookup_fqdn()
     if dns_fqdn.find(".") == -1:
         domain = str(config("domain"))
     else:
@@ -127,6 +352,7 @@ def my_hostnames():
     return hostname, fqdn
 
 
+@cached
 def get_default_gw_ip():
     """Get the IP used to reach the default gateway."""
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -147,6 +373,10 @@ def copy_files(charm_dir):
         "%s/files/rsync_userdata.py" % charm_dir, "/usr/local/sbin/rsync_userdata.py"
     )
     os.chmod("/usr/local/sbin/rsync_userdata.py", 0o755)
+    shutil.copyfile(
+        "%s/files/udldap_job.py" % charm_dir, "/usr/local/sbin/udldap_job.py"
+    )
+    os.chmod("/usr/local/sbin/udldap_job.py", 0o755)
 
 
 def create_ssh_keypair(id_file):
@@ -193,40 +423,262 @@ def handle_local_ssh_keys(root_priv_key, root_ssh_dir="/root/.ssh"):
     )
 
 
-def cronsplay(string, interval=5):
-    """Compute varying intervals for cron."""
-    offsets = []
-    o = binascii.crc_hqx(string.encode(), 0) % interval
-    while o < 60:
-        offsets.append(str(o))
-        o += interval
-    return ",".join(offsets)
+def sync_interval():
+    """Return the sync-interval option in minutes, limited to 1 to 60."""
+    return max(1, min(int(config("sync-interval")), 60))
+
+
+def cronschedule(string, interval=15, phase=0.0):
+    """Compute a cron schedule spread across the interval at seconds granularity.
+
+    interval is in minutes and should divide 60, see sync_interval(). Returns
+    the minute field for cron and the seconds to sleep before running the job.
+    phase shifts the schedule by that fraction of the interval, to keep jobs
+    apart that are scheduled for the same string.
+    """
+    period = interval * 60
+    digest = int(hashlib.sha256(string.encode()).hexdigest(), 16)
+    offset = (digest + int(phase * period)) % period
+    minutes = ",".join(str(m) for m in range(offset // 60, 60, interval))
+    return minutes, offset % 60
+
+
+def udldap_job_args(name, cmd, coalesce=False, backoff=0):
+    """Return the arguments to run the cmd list via udldap_job.py.
+
+    Runs of the job never overlap, and with coalesce overlapping runs are
+    coalesced into one instead of skipped. With backoff, runs are skipped for
+    exponentially longer after consecutive failures, starting at backoff
+    seconds. This records metrics about the job if metrics-textfile-dir is
+    configured.
+    """
+    args = ["/usr/local/sbin/udldap_job.py", "--name", name]
+    metrics_dir = config("metrics-textfile-dir")
+    if metrics_dir:
+        args += ["--metrics-dir", metrics_dir]
+    if coalesce:
+        args.append("--coalesce")
+    if backoff:
+        args += ["--backoff", str(backoff)]
+    return args + ["--"] + cmd
+
+
+def udldap_job_cmd(name, cmd, coalesce=False, backoff=0):
+    """Return the command line to run cmd, a string or list, via udldap_job.py."""
+    if isinstance(cmd, str):
+        cmd = cmd.split()
+    args = udldap_job_args(name, cmd, coalesce, backoff)
+    return " ".join(shlex.quote(arg) for arg in args)
+
+
+def replicate_cmd():
+    """Return the command to run ud-replicate with.
+
+    With nscd, its caches are invalidated after ud-replicate succeeded. Each
+    invalidation runs regardless of the others, the exit status is that of
+    ud-replicate.
+    """
+    if not config("nscd"):
+        return ["/usr/bin/ud-replicate"]
+    return [
+        "sh",
+        "-c",
+        "/usr/bin/ud-replicate || exit; "
+        "/usr/sbin/nscd -i passwd; /usr/sbin/nscd -i group; exit 0",
+    ]
+
+
+def job_state(name):
+    """Return the state udldap_job.py keeps about the named job."""
+    try:
+        with open(UDLDAP_JOB_STATE.format(name)) as fp:
+            return json.load(fp)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def job_running(name):
+    """Return whether a run of the named udldap_job.py job is in progress.
+
+    This goes by the pid udldap_job.py records in the job state while running.
+    The job's lock is left alone, a run starting while it's held would be
+    skipped.
+    """
+    pid = job_state(name).get("running")
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        # Left behind by a run that was killed
+        return False
+    return True
+
+
+def replicate_succeeded():
+    """Return whether the last finished ud-replicate run succeeded."""
+    if job_running("ud-replicate"):
+        return False
+    state = job_state("ud-replicate")
+    return bool(state) and not state.get("failures")
+
+
+def report_replicate_status():
+    """Set the workload status from how ud-replicate is doing."""
+    if job_running("ud-replicate"):
+        status_set("maintenance", "ud-replicate running")
+        return
+    state = job_state("ud-replicate")
+    if state.get("failures"):
+        status_set(
+            "blocked", "ud-replicate failed {} times in a row".format(state["failures"])
+        )
+    elif state:
+        status_set("active", "")
+
+
+def start_replicate(wait=REPLICATE_WAIT):
+    """Run ud-replicate in a background systemd unit and wait for it a while.
+
+    Returns True if it succeeded, False if it failed, or None if it is still
+    running after wait seconds. The workload status is updated either way.
+    """
+    started = time.time()
+    try:
+        subprocess.check_call(
+            ["systemd-run", "--unit", REPLICATE_UNIT, "--collect", "--quiet"]
+            + udldap_job_args("ud-replicate", replicate_cmd(), coalesce=True)
+        )
+    except subprocess.CalledProcessError:
+        # Most likely still running from an earlier hook
+        log("Unable to start {}".format(REPLICATE_UNIT), level=WARNING)
+    status_set("maintenance", "ud-replicate running")
+    while True:
+        state = job_state("ud-replicate")
+        if state.get("last_run", 0) >= started:
+            report_replicate_status()
+            return state["returncode"] == 0
+        if time.time() - started > wait:
+            return None
+        time.sleep(1)
 
 
 def setup_udreplicate_cron():
     """Set up ud-replicate cron with a little variation."""
+    minutes, delay = cronschedule(local_unit(), sync_interval())
     with open("/etc/cron.d/ud-replicate", "w") as f:
         f.write(
             "# This file is managed by juju\n"
             "# userdir-ldap updates\n"
-            "{} * * * * root /usr/bin/ud-replicate\n".format(
-                cronsplay(local_unit(), 15)
+            "{} * * * * root sleep {} && {}\n".format(
+                minutes,
+                delay,
+                udldap_job_cmd(
+                    "ud-replicate", replicate_cmd(), backoff=sync_interval() * 60
+                ),
             )
         )
 
 
 def setup_rsync_userdata_cron():
-    """Set up rsync_userdata.py cron with a little variation."""
-    with open("/etc/cron.d/rsync_userdata", "w") as f:
+    """Set up rsync_userdata.py cron with a little variation.
+
+    This runs half an interval apart from ud-replicate.
+    """
+    minutes, delay = cronschedule(local_unit(), sync_interval(), phase=0.5)
+    with open(RSYNC_USERDATA_CRON, "w") as f:
         f.write(
             "# This file is managed by juju\n"
-            "{} * * * * root [ -f /var/lib/misc/rsync_userdata.cfg ] && "
-            "/usr/local/sbin/rsync_userdata.py < /var/lib/misc/rsync_userdata.cfg \n".format(  # noqa: E501
-                cronsplay(local_unit(), 15)
+            "{} * * * * root [ -f {cfg} ] && sleep {} && {}\n".format(
+                minutes,
+                delay,
+                udldap_job_cmd(
+                    "rsync_userdata",
+                    "/usr/local/sbin/rsync_userdata.py --config {}".format(
+                        RSYNC_USERDATA_CFG
+                    ),
+                    coalesce=True,
+                    backoff=sync_interval() * 60,
+                ),
+                cfg=RSYNC_USERDATA_CFG,
             )
         )
 
 
+def rank_upstreams(addresses, unit):
+    """Order the upstream addresses by preference for unit.
+
+    This uses rendezvous hashing on the unit name, so consumers are spread
+    evenly across producers, and adding or removing a producer only moves
+    the consumers that preferred it.
+    """
+    return sorted(
+        addresses,
+        key=lambda address: hashlib.sha256(
+            "{} {}".format(unit, address).encode()
+        ).hexdigest(),
+        reverse=True,
+    )
+
+
+def probe_upstream(address, timeout=UPSTREAM_PROBE_TIMEOUT):
+    """Return the seconds it takes to connect to ssh on address, None on failure."""
+    start = time.monotonic()
+    try:
+        with socket.create_connection((address, 22), timeout=timeout):
+            return time.monotonic() - start
+    except OSError:
+        return None
+
+
+def select_upstream(
+    addresses,
+    unit,
+    current=None,
+    max_latency=UPSTREAM_MAX_LATENCY,
+    fast_latency=UPSTREAM_FAST_LATENCY,
+):
+    """Select the upstream address for unit to sync user data from.
+
+    The addresses are probed in the order of rank_upstreams(). The current
+    upstream is kept while it answers within max_latency, unless one ranked
+    before it answers within fast_latency. Otherwise the first one answering
+    within max_latency is picked. If none does, the current upstream is kept
+    if it answers at all, otherwise the first one answering in rank order is
+    picked, and if none answers the most preferred one. Probe latencies only
+    decide whether an address is usable, and the gap between the two
+    thresholds keeps latencies around either from moving consumers back and
+    forth between producers.
+
+    Returns (address, latency), latency being None if the probe failed.
+    """
+    ranked = rank_upstreams(addresses, unit)
+    latencies = {}
+
+    def first_within(candidates, limit):
+        for address in candidates:
+            if address not in latencies:
+                latencies[address] = probe_upstream(address)
+                log(
+                    "Upstream {} probe: {}".format(address, latencies[address]),
+                    level=DEBUG,
+                )
+            latency = latencies[address]
+            if latency is not None and latency <= limit:
+                return address, latency
+        return None
+
+    selected = None
+    if current in ranked:
+        selected = first_within(
+            ranked[: ranked.index(current)], fast_latency
+        ) or first_within([current], max_latency)
+    selected = selected or first_within(ranked, max_latency)
+    if not selected and latencies.get(current) is not None:
+        selected = current, latencies[current]
+    return selected or first_within(ranked, float("inf")) or (ranked[0], None)
+
+
 def determine_userdb_ip():
     """Return the userdb.internal ip address for ud-replicating.
 
@@ -282,28 +734,262 @@ def update_hosts(userdb_host, userdb_ip):
         os.rename(tempfile, HOSTS_FILE)
 
 
-def update_ssh_known_hosts(hosts, ssh_dir="/root/.ssh"):
-    """Scan for new host keys."""
+def known_host_matches(line, host):
+    """Return whether the known_hosts line is a host key entry for host.
+
+    Hashed host names are matched too, lines with markers like @revoked never.
+    """
+    fields = line.split()
+    if not fields or fields[0].startswith(("#", "@")):
+        return False
+    for pattern in fields[0].split(","):
+        if pattern.startswith("|1|"):
+            salt, digest = pattern[3:].split("|", 1)
+            mac = hmac.new(base64.b64decode(salt), host.encode(), "sha1")
+            if hmac.compare_digest(base64.b64encode(mac.digest()).decode(), digest):
+                return True
+        elif pattern == host:
+            return True
+    return False
+
+
+def read_known_hosts(path):
+    """Return the non-empty lines of a known_hosts file, whitespace normalized."""
+    try:
+        with open(path) as fp:
+            lines = [" ".join(line.split()) for line in fp]
+    except FileNotFoundError:
+        return []
+    return [line for line in lines if line]
+
+
+def write_known_hosts(path, old, new):
+    """Atomically write the lines new to path, unless they are the lines old.
+
+    Duplicates are dropped and order doesn't matter when comparing. Returns
+    whether path was written.
+    """
+    new = list(dict.fromkeys(new))
+    if set(new) == set(old):
+        return False
+    tmppath = "{}.{}".format(path, os.getpid())
+    with open(tmppath, "w") as fp:
+        fp.write("".join(line + "\n" for line in new))
+    os.chmod(tmppath, 0o644)
+    os.replace(tmppath, path)
+    log("Updated {}".format(path), level=DEBUG)
+    return True
+
+
+def add_known_hosts(entries, ssh_dir="/root/.ssh"):
+    """Add the known_hosts lines entries that aren't there yet."""
+    if not os.path.exists(ssh_dir):
+        os.makedirs(ssh_dir, mode=0o700)
+    known_hosts = os.path.join(ssh_dir, "known_hosts")
+    old = read_known_hosts(known_hosts)
+    entries = [" ".join(line.split()) for line in entries]
+    return write_known_hosts(known_hosts, old, old + [line for line in entries if line])
+
+
+def keyscan(host, timeout=KEYSCAN_TIMEOUT):
+    """Return the rsa host key entries of host, or None if it can't be scanned."""
+    try:
+        output = subprocess.check_output(
+            ["/usr/bin/ssh-keyscan", "-T", str(timeout), "-t", "rsa", host],
+            stderr=subprocess.DEVNULL,
+            timeout=timeout * 2,
+            universal_newlines=True,
+        )
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired):
+        return None
+    entries = [" ".join(line.split()) for line in output.splitlines()]
+    return [line for line in entries if line and not line.startswith("#")] or None
+
+
+def update_ssh_known_hosts(hosts, ssh_dir="/root/.ssh", timeout=KEYSCAN_TIMEOUT):
+    """Scan for new host keys.
+
+    The hosts are scanned concurrently. Their entries in known_hosts, hashed or
+    not, are replaced by the scanned ones; the entries of hosts that can't be
+    scanned are kept. known_hosts is only rewritten if that changed anything.
+    """
     if isinstance(hosts, str):
         hosts = [hosts]
     if not os.path.exists(ssh_dir):
         os.makedirs(ssh_dir, mode=0o700)
-    known_hosts = "{}/known_hosts".format(ssh_dir)
-    if os.path.exists(known_hosts):
-        for h in hosts:
-            subprocess.check_call(["/usr/bin/ssh-keygen", "-R", h, "-f", known_hosts])
-    with open(known_hosts, "a") as fp:
-        try:
-            subprocess.check_call(
-                ["/usr/bin/ssh-keyscan", "-t", "rsa"] + hosts, stdout=fp
-            )
-            status_set("active", "")
-        except subprocess.CalledProcessError:
-            log("Unable to connect : {}".format(hosts), level=WARNING)
-            status_set(
-                "blocked",
-                "Provided userdb-ip is unreachable.",
+    known_hosts = os.path.join(ssh_dir, "known_hosts")
+    with ThreadPoolExecutor(max_workers=len(hosts) or 1) as executor:
+        scanned = dict(zip(hosts, executor.map(lambda h: keyscan(h, timeout), hosts)))
+    old = read_known_hosts(known_hosts)
+    new = [
+        line
+        for line in old
+        if not any(known_host_matches(line, h) for h in hosts if scanned[h])
+    ]
+    for entries in scanned.values():
+        new += entries or []
+    write_known_hosts(known_hosts, old, new)
+    unreachable = [h for h in hosts if not scanned[h]]
+    if unreachable:
+        log("Unable to connect : {}".format(unreachable), level=WARNING)
+        status_set(
+            "blocked",
+            "Provided userdb-ip is unreachable.",
+        )
+    else:
+        status_set("active", "")
+
+
+def sshd_keyword(line):
+    """Return the lowercased keyword and the value of an sshd_config line.
+
+    Returns (None, None) for comments and empty lines.
+    """
+    line = line.strip()
+    if not line or line.startswith("#"):
+        return None, None
+    match = re.match(r"([^\s=]+)\s*=?\s*(.*)", line)
+    return match.group(1).lower(), " ".join(match.group(2).split())
+
+
+def sshd_config_lines(path, depth=0):
+    """Yield the (keyword, value) settings of an sshd config file.
+
+    Included files are followed, settings in Match blocks are left out.
+    """
+    if depth > 16:
+        raise UserdirLdapError("Too many nested Includes in {}".format(path))
+    with open(path) as fp:
+        for line in fp:
+            keyword, value = sshd_keyword(line)
+            if keyword == "match":
+                return
+            if keyword != "include":
+                if keyword:
+                    yield keyword, value
+                continue
+            for pattern in value.split():
+                pattern = os.path.join(os.path.dirname(SSHD_CONFIG), pattern)
+                for included in sorted(glob.glob(pattern)):
+                    yield from sshd_config_lines(included, depth + 1)
+
+
+def sshd_settings(path):
+    """Return the settings in effect with the sshd config file at path.
+
+    This maps lowercased keywords to their value, like sshd the first value
+    given wins, except for keywords that can be given several times, these
+    map to the list of their values.
+    """
+    settings = {}
+    for keyword, value in sshd_config_lines(path):
+        if keyword in SSHD_MULTI_KEYWORDS:
+            settings.setdefault(keyword, []).append(value)
+        else:
+            settings.setdefault(keyword, value)
+    return settings
+
+
+def render_sshd_config(path, conf, disabled_host_keys=()):
+    """Return the content of the sshd config file at path, changed to conf.
+
+    Lines for the keywords in conf are replaced by the values there, or
+    commented out if that is empty. Missing ones are added before the first
+    Match block. HostKey lines for disabled_host_keys are commented out.
+    """
+    wanted = {keyword.lower(): (keyword, value) for keyword, value in conf.items()}
+    done = set()
+    lines = []
+    match_at = None
+    with open(path) as fp:
+        for line in fp:
+            keyword, value = sshd_keyword(line)
+            if keyword == "match" and match_at is None:
+                match_at = len(lines)
+            if match_at is None and keyword in wanted:
+                name, wanted_value = wanted[keyword]
+                if wanted_value and keyword not in done:
+                    line = "{} {}\n".format(name, wanted_value)
+                else:
+                    line = "#{}".format(line)
+                done.add(keyword)
+            elif keyword == "hostkey" and value in disabled_host_keys:
+                line = "#{}".format(line)
+            lines.append(line)
+    if lines and not lines[-1].endswith("\n"):
+        lines[-1] += "\n"
+    if match_at is None:
+        match_at = len(lines)
+    lines[match_at:match_at] = [
+        "{} {}\n".format(name, value)
+        for keyword, (name, value) in wanted.items()
+        if value and keyword not in done
+    ]
+    return "".join(lines)
+
+
+def validate_sshd_config(path):
+    """Return whether sshd accepts the config file at path."""
+    try:
+        subprocess.check_output(
+            ["/usr/sbin/sshd", "-t", "-f", path], stderr=subprocess.STDOUT
+        )
+    except subprocess.CalledProcessError as e:
+        log("Invalid sshd config {}: {}".format(path, e.output), level=ERROR)
+        return False
+    return True
+
+
+def update_sshd_config(conf, disabled_host_keys=(), path=SSHD_CONFIG):
+    """Change the sshd config file at path to conf, see render_sshd_config().
+
+    The new config is validated with sshd -t before it replaces the old one,
+    the old one is kept as path.orig. Returns the keywords whose effective
+    value changed, Included files taken into account.
+    """
+    content = render_sshd_config(path, conf, disabled_host_keys)
+    with open(path) as fp:
+        if fp.read() == content:
+            return []
+    new_path = path + ".new"
+    with open(new_path, "w") as fp:
+        fp.write(content)
+    os.chmod(new_path, 0o644)
+    if not validate_sshd_config(new_path):
+        os.unlink(new_path)
+        raise UserdirLdapError("sshd config not valid, see the log")
+    old, new = sshd_settings(path), sshd_settings(new_path)
+    for keyword, value in conf.items():
+        if value and new.get(keyword.lower()) != value:
+            log(
+                "{} {} is overridden by an earlier setting".format(keyword, value),
+                level=WARNING,
             )
+    os.rename(path, path + ".orig")
+    os.rename(new_path, path)
+    return sorted(k for k in set(old) | set(new) if old.get(k) != new.get(k))
+
+
+def reload_sshd():
+    """Reload sshd and clear the pending reload."""
+    service_reload("ssh")
+    db = unitdata.kv()
+    db.unset("sshd.reload_pending")
+    db.flush()
+
+
+@cached
+def schedule_sshd_reload():
+    """Reload sshd at the end of the hook, once however often this is called.
+
+    The pending reload is remembered, to reload in a later hook if this one
+    fails before it could.
+    """
+    db = unitdata.kv()
+    db.set("sshd.reload_pending", True)
+    db.flush()
+    atexit(reload_sshd)
+    return True
 
 
 def install_sudoer_group(no_pass_groups, password_groups, **kwargs):
@@ -324,6 +1010,73 @@ def install_sudoer_group(no_pass_groups, password_groups, **kwargs):
     )
 
 
+def read_user_keys(entry):
+    """Return the ~/.ssh/authorized_keys of the passwd entry, None if missing."""
+    try:
+        with open(os.path.join(entry.pw_dir, ".ssh/authorized_keys"), "rb") as fp:
+            return fp.read()
+    except (FileNotFoundError, NotADirectoryError, IsADirectoryError):
+        return None
+
+
+def file_digest(path):
+    """Return the sha256 digest of the file at path, None if it's missing."""
+    try:
+        with open(path, "rb") as fp:
+            return hashlib.sha256(fp.read()).digest()
+    except FileNotFoundError:
+        return None
+
+
+def migrate_user_keys(users, dst_keydir=USER_KEYS_DIR):
+    """Copy the ~/.ssh/authorized_keys of users to dst_keydir.
+
+    The passwd database is read once, keyfiles already in dst_keydir with
+    the same content are left alone and the others are replaced atomically.
+    Returns a dict with the lists of users whose keyfile was "migrated" or
+    "unchanged", who are "missing" or have "no_keys" to migrate.
+    """
+    passwd = {entry.pw_name: entry for entry in pwd.getpwall()}
+    result = {"migrated": [], "unchanged": [], "missing": [], "no_keys": []}
+    for username in users:
+        try:
+            # getpwall() doesn't list users of sources that can't enumerate
+            entry = passwd.get(username) or pwd.getpwnam(username)
+        except KeyError:
+            result["missing"].append(username)
+            continue
+        keys = read_user_keys(entry)
+        if keys is None:
+            result["no_keys"].append(username)
+            continue
+        dst_keyfile = os.path.join(dst_keydir, username)
+        if file_digest(dst_keyfile) == hashlib.sha256(keys).digest():
+            result["unchanged"].append(username)
+            continue
+        tmppath = "{}.{}".format(dst_keyfile, os.getpid())
+        with open(tmppath, "wb") as fp:
+            fp.write(keys)
+        os.chmod(tmppath, 0o444)
+        os.chown(tmppath, 0, 0)
+        os.replace(tmppath, dst_keyfile)
+        result["migrated"].append(username)
+    return result
+
+
+def write_nscd_conf(ttl):
+    """Render the nscd config, returns whether it changed."""
+    try:
+        with open(NSCD_CONF) as fp:
+            old = fp.read()
+    except FileNotFoundError:
+        old = None
+    templating.render(
+        source=NSCD_TMPL, target=NSCD_CONF, context={"ttl": ttl}, perms=0o644
+    )
+    with open(NSCD_CONF) as fp:
+        return fp.read() != old
+
+
 def enable_pam_mkhomedir():
     """Create homedirectories upon first login."""
     cmd = ["/usr/sbin/pam-auth-update", "--enable", "mkhomedir"]
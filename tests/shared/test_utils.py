@@ -1,6 +1,7 @@
 """Shared test code."""
 
 import grp
+import importlib.util
 import os
 import pwd
 import tempfile
@@ -42,3 +43,14 @@ def effective_user():
 def effective_group():
     """Return the effective group's name."""
     return grp.getgrgid(os.getegid()).gr_name
+
+
+def load_file_module(name):
+    """Import one of the charm's scripts from files/ as a module."""
+    charm_dir = Path(__file__).resolve().parent.parent.parent
+    spec = importlib.util.spec_from_file_location(
+        name, str(charm_dir / "files" / "{}.py".format(name))
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
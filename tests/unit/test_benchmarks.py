@@ -0,0 +1,383 @@
+"""Benchmarks for charm-userdir-ldap.
+
+These are skipped unless TEST_BENCHMARK is set in the environment, e.g.:
+
+    TEST_BENCHMARK=1 tox -e benchmark
+"""
+
+import json
+import os
+import pwd
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+from pathlib import Path
+from subprocess import DEVNULL, call, check_call
+from unittest.mock import patch
+
+from charmhelpers.core import hookenv
+
+from tests.shared.test_utils import load_file_module
+
+import utils
+
+rsync_userdata = load_file_module("rsync_userdata")
+
+# Stand-in for the juju hook tools, serving relation data from a JSON file
+FAKE_HOOK_TOOL = """
+import json, os, sys
+with open(os.environ["FAKE_RELATION_DATA"]) as fp:
+    data = json.load(fp)
+tool = os.path.basename(sys.argv[0])
+args = [arg for arg in sys.argv[1:] if arg != "--format=json"]
+out = None
+if tool == "relation-ids":
+    out = sorted(data)
+elif tool == "relation-list":
+    out = sorted(data[args[1]])
+elif tool == "relation-get":
+    settings = data[args[1]][args[3]]
+    out = settings if args[2] == "-" else settings.get(args[2])
+print(json.dumps(out))
+"""
+
+# Stand-in for rsync over a link of RATE bytes per second, syncing SRC into
+# DST/<basename of SRC>. Files with the size and mtime of their copy in the
+# --link-dest dir are hard linked from there, the others are copied and logged
+# in rsync_userdata.OUT_FORMAT
+FAKE_RSYNC = """
+import os, shutil, sys, time
+rate = float(sys.argv[1])
+src, dst = sys.argv[-2:]
+link_dest = [arg.split("=", 1)[1] for arg in sys.argv if "--link-dest=" in arg]
+name = os.path.basename(src)
+os.makedirs(os.path.join(dst, name))
+start = time.monotonic()
+transferred = sent = 0
+for fn in sorted(os.listdir(src)):
+    st = os.stat(os.path.join(src, fn))
+    target = os.path.join(dst, name, fn)
+    if link_dest:
+        old = os.path.join(link_dest[0], name, fn)
+        old_st = os.stat(old) if os.path.exists(old) else None
+        if old_st and (old_st.st_size, old_st.st_mtime) == (st.st_size, st.st_mtime):
+            os.link(old, target)
+            continue
+    # The link keeps sending while this is descheduled
+    sent += st.st_size
+    time.sleep(max(0, start + sent / rate - time.monotonic()))
+    shutil.copy2(os.path.join(src, fn), target)
+    transferred += 1
+    print("{} {}/{}".format(st.st_size, name, fn), flush=True)
+print()
+print("Number of regular files transferred: {}".format(transferred))
+"""
+
+
+def make_tree(root, num_files, files_per_dir=1000):
+    """Create a synthetic tree of num_files small files below root."""
+    for i in range(num_files):
+        subdir = root / "host{}".format(i // files_per_dir)
+        if not i % files_per_dir:
+            subdir.mkdir(parents=True)
+        (subdir / "file{}".format(i)).write_text("data{}\n".format(i))
+
+
+def tree_relpaths(root):
+    """Return the paths of the dirs and files below root, relative to it."""
+    relpaths = []
+    for dirpath, dirnames, filenames in os.walk(str(root)):
+        relpaths.extend(
+            os.path.relpath(os.path.join(dirpath, name), str(root))
+            for name in dirnames + filenames
+        )
+    return relpaths
+
+
+def make_host_dirs(root, num_hosts):
+    """Create num_hosts empty host dirs below root, returns their paths."""
+    paths = [root / "host{}".format(i) for i in range(num_hosts)]
+    for path in paths:
+        path.mkdir(parents=True)
+    return paths
+
+
+def copy_overrides(override_dir, host_paths, published=None):
+    """Copy the local overrides into host_paths.
+
+    Without published host dirs to refer to, this copies every file into every
+    host dir the way rsync_userdata used to.
+    """
+    for i, host_path in enumerate(host_paths):
+        if published:
+            rsync_userdata.copyfiles(override_dir, host_path, published[i])
+        else:
+            for fn in override_dir.glob("*"):
+                shutil.copy(str(fn), str(host_path / fn.name))
+
+
+def make_hook_tools(root, num_units):
+    """Install fake hook tools for num_units udprovide units below root.
+
+    Returns the environment to run the hook tools with.
+    """
+    tools = root / "tools"
+    tools.mkdir()
+    tool = tools / "hook-tool"
+    tool.write_text("#!{} -S\n{}".format(sys.executable, FAKE_HOOK_TOOL))
+    tool.chmod(0o755)
+    for name in ("relation-ids", "relation-list", "relation-get", "juju-log"):
+        (tools / name).symlink_to(tool)
+    data = {
+        "udprovide:1": {
+            "consumer/{}".format(i): {
+                "pub_key": "ssh-rsa KEY{} root@consumer{}".format(i, i),
+                "template_host": "template{}".format(i % 10) if i % 2 else "",
+            }
+            for i in range(num_units)
+        }
+    }
+    (root / "relation-data.json").write_text(json.dumps(data))
+    return {
+        "FAKE_RELATION_DATA": str(root / "relation-data.json"),
+        "PATH": "{}:{}".format(tools, os.environ["PATH"]),
+    }
+
+
+def relation_get_per_attribute(fqdn):
+    """Collect the udprovide units with one relation-get per attribute."""
+    ud_units = set()
+    for rid in hookenv.relation_ids("udprovide"):
+        for unit in hookenv.related_units(relid=rid):
+            pub_key = hookenv.relation_get("pub_key", unit, rid)
+            host = hookenv.relation_get("template_host", unit, rid) or fqdn
+            if pub_key and host:
+                ud_units.add((pub_key, host))
+    return ud_units
+
+
+def getpwnam_users(users):
+    """Look up each of users by name like getent passwd would."""
+    for user in users:
+        try:
+            pwd.getpwnam(user)
+        except KeyError:
+            pass
+
+
+def spawn_getent(users):
+    """Run getent passwd for each of users."""
+    for user in users:
+        call(["getent", "passwd", user], stdout=DEVNULL)
+
+
+def make_upstream(root, num_files, size, step=1):
+    """Create an upstream host dir with num_files files and SHA256SUMS.
+
+    With step, only every step-th file is written, i.e. changed.
+    """
+    root.mkdir(parents=True, exist_ok=True)
+    for i in range(0, num_files, step):
+        (root / "file{}".format(i)).write_bytes(os.urandom(size))
+    lines = []
+    for i in range(num_files):
+        digest = rsync_userdata.file_digest(root / "file{}".format(i))
+        lines.append("{}  file{}\n".format(digest, i))
+    (root / "SHA256SUMS").write_text("".join(lines))
+
+
+def local_rsync_cmd(upstream, rate):
+    """Return a stand-in for rsync_cmd() syncing from the local upstream dir.
+
+    The files are sent at rate bytes per second, like over a network.
+    """
+
+    def rsync_cmd(key_file, server_user, remote_dir, local_dir, options, cp):
+        return (
+            [sys.executable, "-c", FAKE_RSYNC, str(rate)]
+            + list(options)
+            + [str(upstream / remote_dir), local_dir]
+        )
+
+    return rsync_cmd
+
+
+def fetch_times(cfg, upstream, staging_dir, options=(), rate=100e6, runs=3):
+    """Time fetch_host() of host0 without and with verify, best of runs.
+
+    Returns both times in seconds and the time spent verifying after rsync
+    finished.
+    """
+    timings = {False: [], True: []}
+    tail = 0
+    with patch.object(
+        rsync_userdata, "rsync_cmd", side_effect=local_rsync_cmd(upstream, rate)
+    ):
+        for verify in (False, True) * runs:
+            start = time.monotonic()
+            stats = rsync_userdata.fetch_host(
+                dict(cfg, verify=verify), "host0", staging_dir, list(options)
+            )
+            timings[verify].append(time.monotonic() - start)
+            tail = stats.get("verify_seconds", tail)
+            shutil.rmtree(str(staging_dir / "host0"))
+    return min(timings[False]), min(timings[True]), tail
+
+
+def timed(func, *args, **kwargs):
+    """Return the wall clock time func(*args, **kwargs) takes in seconds."""
+    start = time.monotonic()
+    func(*args, **kwargs)
+    return time.monotonic() - start
+
+
+@unittest.skipUnless(os.environ.get("TEST_BENCHMARK"), "TEST_BENCHMARK not set")
+class TestBenchmarks(unittest.TestCase):
+    """Benchmark test class."""
+
+    def setUp(self):
+        """Run before each benchmark."""
+        self.tmp = Path(tempfile.mkdtemp())
+
+    def tearDown(self):
+        """Run after each benchmark."""
+        shutil.rmtree(str(self.tmp))
+
+    @unittest.skipUnless(os.geteuid() == 0, "chown to nobody needs root")
+    def test_chown_paths(self):
+        """Compare chown -R with rsync_userdata.chown_paths() on 100k files.
+
+        The tree is freshly written and owned by root, as staged by a full
+        rsync, and then with only every 100th file new, as staged in snapshot
+        mode where the others are hard linked from the published tree.
+        """
+        uid = pwd.getpwnam("nobody").pw_uid
+        for label, step in (("fresh", 1), ("every 100th new", 100)):
+            times = []
+            for i in range(2):
+                root = self.tmp / "{}-{}".format(step, i)
+                make_tree(root, 100000)
+                relpaths = tree_relpaths(root)
+                # rsync reports the freshly staged dirs and the new files
+                new = [p for p in relpaths if "/" not in p]
+                new += [p for p in relpaths if "/" in p][::step]
+                if step > 1:
+                    check_call(["chown", "-R", "nobody", str(root)])
+                    for relpath in new:
+                        os.lchown(str(root / relpath), 0, -1)
+                if i:
+                    times.append(timed(rsync_userdata.chown_paths, root, new, uid))
+                else:
+                    times.append(
+                        timed(check_call, ["chown", "-R", "nobody", str(root)])
+                    )
+                shutil.rmtree(str(root))
+            print(
+                "\nchown 100k files, {}: chown -R {:.2f}s, "
+                "chown_paths {:.2f}s".format(label, *times)
+            )
+
+    def test_copyfiles(self):
+        """Compare copying all local overrides with the incremental copyfiles()."""
+        make_tree(self.tmp / "overrides", 20)
+        override_dir = self.tmp / "overrides" / "host0"
+        for num_hosts in (10, 100, 1000):
+            published = make_host_dirs(self.tmp / "published", num_hosts)
+            for host_path in published:
+                rsync_userdata.copyfiles(override_dir, host_path)
+            staging = make_host_dirs(self.tmp / "staging", num_hosts)
+            full = timed(copy_overrides, override_dir, staging)
+            shutil.rmtree(str(self.tmp / "staging"))
+            staging = make_host_dirs(self.tmp / "staging", num_hosts)
+            incremental = timed(
+                copy_overrides, override_dir, staging, published=published
+            )
+            print(
+                "\n{} hosts x 20 overrides: copy {:.3f}s, copyfiles {:.3f}s".format(
+                    num_hosts, full, incremental
+                )
+            )
+            shutil.rmtree(str(self.tmp / "published"))
+            shutil.rmtree(str(self.tmp / "staging"))
+
+    def test_udprovide_units(self):
+        """Compare reading udprovide relation data per attribute and per unit."""
+        for num_units in (10, 100, 1000, 5000):
+            root = self.tmp / str(num_units)
+            root.mkdir()
+            with patch.dict(os.environ, make_hook_tools(root, num_units)):
+                hookenv.cache.clear()
+                per_attribute = timed(relation_get_per_attribute, "producer")
+                hookenv.cache.clear()
+                per_unit = timed(utils.udprovide_units, "producer")
+                hookenv.cache.clear()
+            print(
+                "\n{} udprovide units: per attribute {:.2f}s, per unit {:.2f}s".format(
+                    num_units, per_attribute, per_unit
+                )
+            )
+
+    def test_nss_lookups(self):
+        """Measure passwd lookups per second, with cold and warm nscd caches.
+
+        Run this on a unit to measure the NSS setup there, e.g. with and
+        without the nscd option; without nscd, cold and warm are the same.
+        """
+        users = [entry.pw_name for entry in pwd.getpwall()]
+        users += ["missing{}".format(i) for i in range(len(users) // 10)]
+        nscd = shutil.which("nscd") and call(["nscd", "-i", "passwd"]) == 0
+        cold = timed(getpwnam_users, users)
+        warm = min(timed(getpwnam_users, users) for _ in range(5))
+        getent = timed(spawn_getent, users[:200]) / min(len(users), 200)
+        print(
+            "\n{} passwd lookups ({}): cold {:.0f}/s, warm {:.0f}/s, "
+            "getent processes {:.0f}/s".format(
+                len(users),
+                "nscd" if nscd else "no nscd",
+                len(users) / cold,
+                len(users) / warm,
+                1 / getent,
+            )
+        )
+
+    def test_verify(self):
+        """Check that streaming verification keeps fetches under twice as long.
+
+        The host dir is fetched at 100MB/s, in full, and in snapshot mode
+        with every 100th file changed since the last verified fetch.
+        """
+        cfg = {"key_file": "", "dist_user": "", "local_overrides": []}
+        staging_dir = self.tmp / "staging"
+        staging_dir.mkdir()
+        local_dir = self.tmp / "hosts"
+        local_dir.mkdir()
+        snapshot = dict(cfg, local_dir=str(local_dir), snapshot=True)
+        options = ["--link-dest={}".format(local_dir)]
+        for num_files, size in ((20, 8 << 20), (5000, 16 << 10)):
+            upstream = self.tmp / "upstream"
+            make_upstream(upstream / "host0", num_files, size)
+            full = fetch_times(cfg, upstream, staging_dir)
+            # Publish a verified fetch, then change upstream
+            rsync_cmd = local_rsync_cmd(upstream, float("inf"))
+            with patch.object(rsync_userdata, "rsync_cmd", side_effect=rsync_cmd):
+                rsync_userdata.fetch_host(
+                    dict(snapshot, verify=True), "host0", staging_dir, options
+                )
+            (staging_dir / "host0").rename(local_dir / "host0")
+            make_upstream(upstream / "host0", num_files, size, step=100)
+            incremental = fetch_times(snapshot, upstream, staging_dir, options)
+            for label, (plain, verify, tail) in (
+                ("", full),
+                (", every 100th changed", incremental),
+            ):
+                print(
+                    "\n{} files of {}KiB{}: fetch {:.2f}s, with verify {:.2f}s "
+                    "({:.2f}s after rsync finished)".format(
+                        num_files, size >> 10, label, plain, verify, tail
+                    )
+                )
+                self.assertLess(verify, 2 * plain)
+            shutil.rmtree(str(upstream))
+            shutil.rmtree(str(local_dir / "host0"))
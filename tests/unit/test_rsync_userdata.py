@@ -0,0 +1,458 @@
+"""Unit tests for files/rsync_userdata.py."""
+
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+from pathlib import Path
+from subprocess import CalledProcessError
+from unittest.mock import MagicMock, patch
+
+from tests.shared.test_utils import effective_user, load_file_module
+
+rsync_userdata = load_file_module("rsync_userdata")
+
+
+RSYNC_STATS = """
+Number of files: 4 (reg: 3, dir: 1)
+Number of created files: 0
+Number of deleted files: 0
+Number of regular files transferred: 2
+Total file size: 12,345 bytes
+Total transferred file size: 1,234 bytes
+Total bytes sent: 70
+Total bytes received: 1,432
+"""
+
+# Stand-in for rsync, copying SRC/* into DST/<basename of SRC> and logging each
+# file in rsync_userdata.OUT_FORMAT
+FAKE_RSYNC = """
+import os, shutil, sys
+src, dst = sys.argv[1:]
+name = os.path.basename(src)
+os.makedirs(os.path.join(dst, name), exist_ok=True)
+print("0 {}/".format(name))
+for fn in sorted(os.listdir(src)):
+    shutil.copy(os.path.join(src, fn), os.path.join(dst, name, fn))
+    print("{} {}/{}".format(os.path.getsize(os.path.join(src, fn)), name, fn))
+print()
+print("Number of regular files transferred: {}".format(len(os.listdir(src))))
+"""
+
+
+def fake_rsync_ud(
+    key_file,
+    server_user,
+    remote_dir,
+    local_dir,
+    options=(),
+    control_path=None,
+    on_file=None,
+):
+    """Stand in for rsync_ud(), creating a host dir with a single file."""
+    if remote_dir.startswith("broken"):
+        raise CalledProcessError(23, "rsync")
+    host_path = Path(local_dir) / remote_dir
+    host_path.mkdir()
+    (host_path / "passwd.tdb").write_text(remote_dir)
+    if on_file:
+        on_file("{}/".format(remote_dir))
+        on_file("{}/passwd.tdb".format(remote_dir))
+    return {"files_transferred": 1, "bytes_received": len(remote_dir)}
+
+
+class TestRsyncUserdata(unittest.TestCase):
+    """Test class for rsync_userdata."""
+
+    def setUp(self):
+        """Run before each test."""
+        self.tmp = Path(tempfile.mkdtemp())
+        self.cfg = {
+            "local_dir": str(self.tmp / "hosts"),
+            "key_file": "/root/.ssh/id_rsa",
+            "host_dirs": ["a.internal", "b.internal", "c.internal"],
+            "local_overrides": [],
+            "dist_user": effective_user(),
+        }
+
+    def tearDown(self):
+        """Run after each test."""
+        shutil.rmtree(str(self.tmp))
+
+    def test_validate_max_parallel(self):
+        """Verify that validate() rejects a bogus max_parallel."""
+        rsync_userdata.validate(dict(self.cfg, max_parallel=4))
+        for bogus in (0, -1, "4"):
+            with self.assertRaises(rsync_userdata.RsyncUserdataError):
+                rsync_userdata.validate(dict(self.cfg, max_parallel=bogus))
+
+    @patch.object(rsync_userdata, "rsync_ud", side_effect=fake_rsync_ud)
+    def test_sync_hosts_parallel(self, _mock_rsync_ud):
+        """Verify that all host_dirs are synced into the staging dir."""
+        self.cfg["max_parallel"] = 2
+        results, failures = rsync_userdata.sync_hosts(self.cfg, self.tmp)
+        self.assertEqual(failures, {})
+        self.assertEqual(sorted(results), self.cfg["host_dirs"])
+        for host_dir in self.cfg["host_dirs"]:
+            self.assertTrue((self.tmp / host_dir / "passwd.tdb").is_file())
+
+    @patch.object(rsync_userdata, "rsync_ud", side_effect=fake_rsync_ud)
+    def test_sync_hosts_failure(self, _mock_rsync_ud):
+        """Verify that a failing host_dir does not stop the others."""
+        self.cfg["host_dirs"].insert(0, "broken.internal")
+        _results, failures = rsync_userdata.sync_hosts(self.cfg, self.tmp)
+        self.assertEqual(list(failures), ["broken.internal"])
+        self.assertTrue((self.tmp / "c.internal" / "passwd.tdb").is_file())
+
+    def test_parse_stats(self):
+        """Verify that rsync --stats output is parsed."""
+        stats = rsync_userdata.parse_stats(RSYNC_STATS)
+        self.assertEqual(stats, {"files_transferred": 2, "bytes_received": 1432})
+
+    @patch.object(rsync_userdata, "rsync_ud")
+    def test_sync_host_snapshot(self, mock_rsync_ud):
+        """Verify that snapshot mode links against the published tree."""
+        (self.tmp / "hosts").mkdir()
+        staging_dir = self.tmp / "staging"
+        self.cfg["snapshot"] = True
+        mock_rsync_ud.return_value = rsync_userdata.parse_stats(RSYNC_STATS)
+        stats = rsync_userdata.sync_host(self.cfg, "a.internal", staging_dir)
+        self.assertEqual(stats["files_transferred"], 2)
+        cmd = mock_rsync_ud.call_args[0][4]
+        self.assertIn("--link-dest={}".format(self.tmp / "hosts"), cmd)
+        self.assertIn("-t", cmd)
+
+    def make_upstream(self, host_dir, files):
+        """Create an upstream host_dir with files and their SHA256SUMS."""
+        upstream = self.tmp / "upstream" / host_dir
+        upstream.mkdir(parents=True)
+        lines = []
+        for name, content in sorted(files.items()):
+            (upstream / name).write_text(content)
+            digest = hashlib.sha256(content.encode()).hexdigest()
+            lines.append("{}  {}\n".format(digest, name))
+        (upstream / "SHA256SUMS").write_text("".join(lines))
+        return upstream
+
+    @patch.object(rsync_userdata, "rsync_cmd")
+    def test_fetch_host_verify(self, mock_rsync_cmd):
+        """Verify that host_dirs are checked against the upstream SHA256SUMS."""
+        mock_rsync_cmd.side_effect = lambda *args: [
+            sys.executable,
+            "-c",
+            FAKE_RSYNC,
+            str(self.tmp / "upstream" / args[2]),
+            args[3],
+        ]
+        upstream = self.make_upstream("a.internal", {"passwd.tdb": "p", "x": "x"})
+        self.cfg["verify"] = True
+        stats = rsync_userdata.fetch_host(self.cfg, "a.internal", self.tmp / "1", [])
+        self.assertEqual(stats["files_transferred"], 3)
+        self.assertIn("verify_seconds", stats)
+        self.assertIn("--out-format=%b %n", mock_rsync_cmd.call_args[0][4])
+        # A truncated file, a missing one and one not in the manifest
+        (upstream / "passwd.tdb").write_text("")
+        (upstream / "x").unlink()
+        (upstream / "y").write_text("y")
+        with self.assertRaises(rsync_userdata.RsyncUserdataError) as cm:
+            rsync_userdata.fetch_host(self.cfg, "a.internal", self.tmp / "2", [])
+        self.assertIn("mismatched ['passwd.tdb']", str(cm.exception))
+        self.assertIn("missing ['x']", str(cm.exception))
+        self.assertIn("unlisted ['y']", str(cm.exception))
+        # Local overrides are not checked
+        (self.tmp / "overrides").mkdir()
+        for name in ("passwd.tdb", "x", "y"):
+            (self.tmp / "overrides" / name).write_text("override")
+        self.cfg["local_overrides"] = [str(self.tmp / "overrides")]
+        rsync_userdata.fetch_host(self.cfg, "a.internal", self.tmp / "3", [])
+        (upstream / "SHA256SUMS").unlink()
+        with self.assertRaises(rsync_userdata.RsyncUserdataError):
+            rsync_userdata.fetch_host(self.cfg, "a.internal", self.tmp / "4", [])
+
+    def test_verifier_received_early(self):
+        """Verify that files rsync reports before they are in place are hashed."""
+        upstream = self.make_upstream("a.internal", {"passwd.tdb": "p"})
+        tmpfile = upstream / ".passwd.tdb.XXXXXX"
+        (upstream / "passwd.tdb").rename(tmpfile)
+        with rsync_userdata.ThreadPoolExecutor(max_workers=2) as pool:
+            verifier = rsync_userdata.Verifier(pool, upstream.parent, "a.internal")
+            # rsync logs the file before renaming it into place
+            verifier.received("a.internal/passwd.tdb")
+            tmpfile.rename(upstream / "passwd.tdb")
+            verifier.check()
+
+    def test_verifier_link_dest(self):
+        """Verify that files hard linked from link_dest are hashed up front."""
+        upstream = self.make_upstream("a.internal", {"passwd.tdb": "p", "x": "x"})
+        staging = self.tmp / "staging" / "a.internal"
+        staging.mkdir(parents=True)
+        for name in ("passwd.tdb", "SHA256SUMS"):
+            os.link(str(upstream / name), str(staging / name))
+        (staging / "x").write_text("x")
+        with rsync_userdata.ThreadPoolExecutor(max_workers=2) as pool:
+            verifier = rsync_userdata.Verifier(
+                pool, self.tmp / "staging", "a.internal", self.tmp / "upstream"
+            )
+            verifier.linked.result()
+            with patch.object(
+                rsync_userdata, "file_digest", wraps=rsync_userdata.file_digest
+            ) as mock_file_digest:
+                verifier.check()
+                # Only the file that is not a hard link is hashed after rsync
+                mock_file_digest.assert_called_once_with(staging / "x")
+                # The next run knows the digests of all files
+                mock_file_digest.reset_mock()
+                rsync_userdata.Verifier(
+                    pool,
+                    self.tmp / "staging",
+                    "a.internal",
+                    self.tmp / "upstream",
+                    verifier.digests,
+                ).check()
+                mock_file_digest.assert_not_called()
+
+    def test_copyfiles_breaks_links(self):
+        """Verify that copyfiles() does not write through hard links."""
+        src, dst = self.tmp / "overrides", self.tmp / "dst"
+        src.mkdir()
+        dst.mkdir()
+        (src / "group.tdb").write_text("override")
+        published = self.tmp / "published"
+        published.write_text("upstream")
+        os.link(str(published), str(dst / "group.tdb"))
+        rsync_userdata.copyfiles(src, dst)
+        self.assertEqual((dst / "group.tdb").read_text(), "override")
+        self.assertEqual(published.read_text(), "upstream")
+
+    @patch.object(rsync_userdata, "call")
+    @patch.object(rsync_userdata, "check_call")
+    def test_ssh_master(self, mock_check_call, mock_call):
+        """Verify that the ssh master is started and torn down."""
+        with rsync_userdata.ssh_master("/id_rsa", "sshdist") as control_path:
+            master_cmd = mock_check_call.call_args[0][0]
+            self.assertIn("-M", master_cmd)
+            self.assertEqual(master_cmd[master_cmd.index("-S") + 1], control_path)
+            mock_call.assert_not_called()
+        mock_call.assert_called_once_with(
+            ["ssh", "-S", control_path, "-O", "exit", "sshdist@userdb.internal"]
+        )
+        with rsync_userdata.ssh_master("/id_rsa", "sshdist", False) as control_path:
+            self.assertIsNone(control_path)
+
+    def test_build_manifest(self):
+        """Verify that manifests record files and reuse unchanged hashes."""
+        (self.tmp / "a.internal").mkdir()
+        (self.tmp / "a.internal" / "passwd.tdb").write_text("root")
+        manifest = rsync_userdata.build_manifest(self.cfg, self.tmp)
+        size, _mtime, digest = manifest["files"]["a.internal/passwd.tdb"]
+        self.assertEqual(size, 4)
+        self.assertEqual(
+            digest, rsync_userdata.file_digest(self.tmp / "a.internal" / "passwd.tdb")
+        )
+        with patch.object(rsync_userdata, "file_digest") as mock_digest:
+            again = rsync_userdata.build_manifest(self.cfg, self.tmp, manifest)
+        mock_digest.assert_not_called()
+        self.assertEqual(again, manifest)
+
+    @patch.object(rsync_userdata, "check_output")
+    def test_nothing_changed(self, mock_check_output):
+        """Verify the dry run check against the published tree."""
+        override_dir = self.tmp / "overrides"
+        override_dir.mkdir()
+        (override_dir / "group.tdb").write_text("override")
+        self.cfg["local_overrides"] = [str(override_dir)]
+        self.cfg["host_dirs"] = ["a.internal"]
+        published = self.tmp / "hosts" / "a.internal"
+        published.mkdir(parents=True)
+        shutil.copy(str(override_dir / "group.tdb"), str(published))
+        manifest = rsync_userdata.build_manifest(self.cfg, self.tmp / "hosts")
+        mock_check_output.return_value = ""
+        self.assertTrue(rsync_userdata.nothing_changed(self.cfg, manifest))
+        cmd = mock_check_output.call_args[0][0]
+        self.assertIn("--dry-run", cmd)
+        self.assertIn("--exclude=/a.internal/group.tdb", cmd)
+        mock_check_output.return_value = ">f.st...... a.internal/passwd.tdb\n"
+        self.assertFalse(rsync_userdata.nothing_changed(self.cfg, manifest))
+        mock_check_output.return_value = ""
+        (override_dir / "group.tdb").write_text("changed")
+        self.assertFalse(rsync_userdata.nothing_changed(self.cfg, manifest))
+
+    @patch.object(rsync_userdata.os, "lchown")
+    @patch.object(rsync_userdata.pwd, "getpwnam")
+    @patch.object(rsync_userdata, "rsync_ud", side_effect=fake_rsync_ud)
+    def test_sync_host_chown(self, _mock_rsync_ud, mock_getpwnam, mock_lchown):
+        """Verify that sync_host() only chowns what rsync reported or copied."""
+        overrides = self.tmp / "overrides"
+        overrides.mkdir()
+        (overrides / "group.tdb").write_text("override")
+        self.cfg["local_overrides"] = [str(overrides)]
+        staging_dir = self.tmp / "staging"
+        staging_dir.mkdir()
+        mock_getpwnam.return_value = MagicMock(pw_uid=4242)
+        rsync_userdata.sync_host(self.cfg, "a.internal", staging_dir)
+        host_path = staging_dir / "a.internal"
+        self.assertEqual(
+            sorted(c[0][0] for c in mock_lchown.call_args_list),
+            sorted(
+                [
+                    str(host_path) + "/",
+                    str(host_path / "passwd.tdb"),
+                    str(host_path / "group.tdb.new"),
+                ]
+            ),
+        )
+        for call in mock_lchown.call_args_list:
+            self.assertEqual(call[0][1:], (4242, -1))
+
+    def test_publish_host(self):
+        """Verify that publish_host() replaces the published host dir."""
+        staged, published = self.tmp / "staged", self.tmp / "published"
+        staged.mkdir()
+        (staged / "passwd.tdb").write_text("new")
+        rsync_userdata.publish_host(staged, published)
+        self.assertEqual((published / "passwd.tdb").read_text(), "new")
+        staged.mkdir()
+        (staged / "passwd.tdb").write_text("newer")
+        rsync_userdata.publish_host(staged, published)
+        self.assertEqual((published / "passwd.tdb").read_text(), "newer")
+        self.assertFalse(staged.exists())
+
+    @patch.object(rsync_userdata, "rsync_ud", side_effect=fake_rsync_ud)
+    def test_sync_hosts_publish_host(self, _mock_rsync_ud):
+        """Verify that healthy host_dirs are published despite a failing one."""
+        local_dir = self.tmp / "hosts"
+        (local_dir / "broken.internal").mkdir(parents=True)
+        staging_dir = self.tmp / "staging"
+        staging_dir.mkdir()
+        self.cfg["host_dirs"].append("broken.internal")
+        self.cfg["publish"] = "host"
+        _results, failures = rsync_userdata.sync_hosts(self.cfg, staging_dir)
+        self.assertEqual(list(failures), ["broken.internal"])
+        self.assertEqual(
+            sorted(p.name for p in local_dir.iterdir()),
+            ["a.internal", "b.internal", "broken.internal", "c.internal"],
+        )
+
+    def test_content_store(self):
+        """Verify that identical files are stored once and linked."""
+        root = self.tmp / "hosts"
+        for host_dir in self.cfg["host_dirs"]:
+            (root / host_dir).mkdir(parents=True)
+            (root / host_dir / "group.tdb").write_text("shared")
+            (root / host_dir / "passwd.tdb").write_text(host_dir)
+        store = rsync_userdata.ContentStore(self.tmp / "store")
+        self.assertEqual(store.dedupe(root), 2)
+        inodes = {(root / h / "group.tdb").stat().st_ino for h in self.cfg["host_dirs"]}
+        self.assertEqual(len(inodes), 1)
+        self.assertEqual(store.dedupe(root), 0)
+        logical, stored = store.gc()
+        self.assertEqual((logical, stored), (3 * 6 + 3 * 10, 6 + 3 * 10))
+        shutil.rmtree(str(root / "a.internal"))
+        logical, stored = store.gc()
+        self.assertEqual((logical, stored), (2 * 6 + 2 * 10, 6 + 2 * 10))
+
+    def test_copyfiles_incremental(self):
+        """Verify that copyfiles() only copies changed files."""
+        src, dst, published = (self.tmp / d for d in ("overrides", "dst", "pub"))
+        for path in (src, dst, published):
+            path.mkdir()
+        (src / "group.tdb").write_text("override")
+        self.assertEqual(rsync_userdata.copyfiles(src, published), 1)
+        self.assertEqual(rsync_userdata.copyfiles(src, published), 0)
+        self.assertEqual(rsync_userdata.copyfiles(src, dst, published), 0)
+        self.assertTrue((dst / "group.tdb").samefile(published / "group.tdb"))
+        (src / "group.tdb").write_text("changed")
+        self.assertEqual(rsync_userdata.copyfiles(src, dst, published), 1)
+        self.assertEqual((dst / "group.tdb").read_text(), "changed")
+        self.assertEqual((published / "group.tdb").read_text(), "override")
+
+    def test_parse_args(self):
+        """Verify that --daemon needs --config."""
+        args = rsync_userdata.parse_args([])
+        self.assertFalse(args.daemon)
+        self.assertIsNone(args.config)
+        args = rsync_userdata.parse_args(["--daemon", "--config", "/cfg"])
+        self.assertTrue(args.daemon)
+        self.assertEqual(args.config, "/cfg")
+        with patch("sys.stderr"), self.assertRaises(SystemExit):
+            rsync_userdata.parse_args(["--daemon"])
+
+    def test_write_metrics(self):
+        """Verify the textfile metrics written after a run."""
+        path = str(self.tmp / "rsync_userdata.prom")
+        self.cfg["host_dirs"] = ["a.internal", "b.internal"]
+        run = {
+            "start": 0,
+            "results": {"a.internal": {"elapsed": 1.5, "bytes_received": 100}},
+            "failures": {"b.internal": OSError()},
+        }
+        rsync_userdata.write_metrics(path, self.cfg, run)
+        rsync_userdata.write_metrics(path, self.cfg, run)
+        metrics = rsync_userdata.read_metrics(path)
+        self.assertEqual(metrics["rsync_userdata_failures_total", ""], 2)
+        self.assertEqual(
+            metrics["rsync_userdata_host_failures_total", '{host_dir="b.internal"}'],
+            2,
+        )
+        self.assertEqual(
+            metrics["rsync_userdata_host_bytes_received", '{host_dir="a.internal"}'],
+            100,
+        )
+        self.assertEqual(
+            metrics[
+                "rsync_userdata_host_last_success_timestamp_seconds",
+                '{host_dir="b.internal"}',
+            ],
+            0,
+        )
+        self.assertEqual(
+            metrics["rsync_userdata_last_success_timestamp_seconds", ""], 0
+        )
+        # Synced, but the tree was not published because of b.internal
+        self.assertEqual(
+            metrics[
+                "rsync_userdata_host_last_success_timestamp_seconds",
+                '{host_dir="a.internal"}',
+            ],
+            0,
+        )
+        # In the "host" publish mode a.internal was published regardless
+        rsync_userdata.write_metrics(
+            path, self.cfg, dict(run, published=["a.internal"])
+        )
+        metrics = rsync_userdata.read_metrics(path)
+        last_a = metrics[
+            "rsync_userdata_host_last_success_timestamp_seconds",
+            '{host_dir="a.internal"}',
+        ]
+        self.assertGreater(last_a, 0)
+        self.assertEqual(
+            metrics[
+                "rsync_userdata_host_last_success_timestamp_seconds",
+                '{host_dir="b.internal"}',
+            ],
+            0,
+        )
+
+    @patch.object(rsync_userdata, "nothing_changed", return_value=True)
+    @patch.object(rsync_userdata, "load_manifest", return_value={"files": {}})
+    def test_write_metrics_skipped(self, _mock_load_manifest, _mock_nothing_changed):
+        """Verify that a skipped run advances the last success of all hosts."""
+        path = str(self.tmp / "rsync_userdata.prom")
+        self.cfg.update(manifest=True, host_dirs=["a.internal", "b.internal"])
+        run = {"start": time.time()}
+        rsync_userdata.sync(self.cfg, run=run)
+        rsync_userdata.write_metrics(path, self.cfg, run)
+        metrics = rsync_userdata.read_metrics(path)
+        self.assertEqual(metrics["rsync_userdata_skipped", ""], 1)
+        for host_dir in self.cfg["host_dirs"]:
+            self.assertGreaterEqual(
+                metrics[
+                    "rsync_userdata_host_last_success_timestamp_seconds",
+                    '{{host_dir="{}"}}'.format(host_dir),
+                ],
+                run["start"],
+            )
@@ -0,0 +1,107 @@
+"""Unit tests for files/udldap_job.py."""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from pathlib import Path
+
+from tests.shared.test_utils import load_file_module
+
+udldap_job = load_file_module("udldap_job")
+
+
+class TestUdldapJob(unittest.TestCase):
+    """Test class for udldap_job."""
+
+    def setUp(self):
+        """Run before each test."""
+        self.tmp = Path(tempfile.mkdtemp())
+        self.dirs = ["--lock-dir", str(self.tmp), "--state-dir", str(self.tmp), "--"]
+
+    def tearDown(self):
+        """Run after each test."""
+        shutil.rmtree(str(self.tmp))
+
+    def test_parse_args(self):
+        """Verify that the job command is taken from after --."""
+        args = udldap_job.parse_args(["--name", "ud-replicate", "--", "ud-replicate"])
+        self.assertEqual(args.name, "ud-replicate")
+        self.assertEqual(args.command, ["ud-replicate"])
+
+    def test_metrics(self):
+        """Verify the metrics written for a failing and a successful run."""
+        argv = ["--name", "test", "--metrics-dir", str(self.tmp)] + self.dirs
+        path = str(self.tmp / "udldap_job_test.prom")
+        self.assertEqual(udldap_job.main(argv + ["false"]), 1)
+        metrics = udldap_job.read_metrics(path)
+        self.assertEqual(metrics["udldap_job_failures_total", '{job="test"}'], 1)
+        self.assertEqual(metrics["udldap_job_exit_code", '{job="test"}'], 1)
+        self.assertEqual(udldap_job.main(argv + ["true"]), 0)
+        metrics = udldap_job.read_metrics(path)
+        self.assertEqual(metrics["udldap_job_failures_total", '{job="test"}'], 1)
+        self.assertGreater(
+            metrics["udldap_job_last_success_timestamp_seconds", '{job="test"}'], 0
+        )
+
+    def test_running_state(self):
+        """Verify that the state records the pid of a run in progress."""
+        state_path = self.tmp / "udldap_job_test.state"
+        during = self.tmp / "during"
+        argv = ["--name", "test"] + self.dirs
+        argv += ["cp", str(state_path), str(during)]
+        self.assertEqual(udldap_job.main(argv), 0)
+        self.assertEqual(udldap_job.read_state(str(during))["running"], os.getpid())
+        self.assertIsNone(udldap_job.read_state(str(state_path))["running"])
+
+    def test_coalesce(self):
+        """Verify that runs requested during a run are coalesced into one."""
+        marker = self.tmp / "runs"
+        cmd = [sys.executable, udldap_job.__file__, "--name", "test", "--coalesce"]
+        cmd += self.dirs
+        with udldap_job.job_lock(str(self.tmp), "test") as reason:
+            self.assertIsNone(reason)
+            queued = subprocess.Popen(
+                cmd + ["sh", "-c", "echo run >> {}".format(marker)]
+            )
+            time.sleep(1)
+            self.assertIsNone(queued.poll())
+            skipped = subprocess.run(cmd + ["false"], timeout=10)
+            self.assertEqual(skipped.returncode, 0)
+        self.assertEqual(queued.wait(timeout=10), 0)
+        self.assertEqual(marker.read_text(), "run\n")
+
+    def test_skip_running(self):
+        """Verify that a run is skipped while another one is in progress."""
+        argv = ["--name", "test", "--metrics-dir", str(self.tmp)] + self.dirs
+        with udldap_job.job_lock(str(self.tmp), "test") as reason:
+            self.assertIsNone(reason)
+            self.assertEqual(udldap_job.main(argv + ["false"]), 0)
+        metrics = udldap_job.read_metrics(str(self.tmp / "udldap_job_test.prom"))
+        self.assertEqual(
+            metrics["udldap_job_skipped_total", '{job="test",reason="running"}'], 1
+        )
+        self.assertNotIn(("udldap_job_exit_code", '{job="test"}'), metrics)
+
+    def test_backoff(self):
+        """Verify the exponential backoff after consecutive failures."""
+        argv = ["--name", "test", "--backoff", "60"] + self.dirs
+        state_path = str(self.tmp / "udldap_job_test.state")
+        self.assertEqual(udldap_job.main(argv + ["false"]), 1)
+        self.assertEqual(udldap_job.main(argv + ["false"]), 0)
+        state = udldap_job.read_state(state_path)
+        self.assertEqual(state["failures"], 1)
+        self.assertEqual(state["skipped"], "backoff")
+        now = state["last_run"]
+        self.assertEqual(udldap_job.backoff_remaining(state, 60, 3600, now + 30), 24)
+        # The next run one interval later isn't skipped, even if slightly early
+        self.assertEqual(udldap_job.backoff_remaining(state, 60, 3600, now + 59), 0)
+        state["failures"] = 3
+        self.assertEqual(udldap_job.backoff_remaining(state, 60, 3600, now), 234)
+        state["failures"] = 10
+        self.assertEqual(udldap_job.backoff_remaining(state, 60, 3600, now), 3594)
+        state["failures"] = 0
+        self.assertEqual(udldap_job.backoff_remaining(state, 60, 3600, now), 0)
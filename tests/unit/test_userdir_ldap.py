@@ -1,17 +1,23 @@
 """Unit tests for charm-userdir-ldap."""
 
+import json
 import os
 import pathlib
 import shutil
 import tempfile
 import textwrap
+import time
 import unittest
 from grp import getgrgid
-from pwd import getpwuid
+from pwd import getpwuid, struct_passwd
+from subprocess import CalledProcessError, DEVNULL, Popen, check_output
 from unittest.mock import patch
 
+from charmhelpers.core import hookenv, unitdata
 from charmhelpers.core.host import write_file
 
+import hooks
+
 from tests.shared.test_utils import (
     effective_group,
     effective_user,
@@ -51,13 +57,40 @@ class TestUserdirLdap(unittest.TestCase):
         """Run once after tests finish."""
         shutil.rmtree(cls.tmp)
 
+    def setUp(self):
+        """Run before each test."""
+        # Lookups are cached for the duration of a hook
+        hookenv.cache.clear()
+
+    @patch("utils.config", return_value=None)
     @patch("utils.os.uname", return_value=["Linux", "foohost"])
     @patch("utils.socket.getfqdn", return_value="foohost.dom")
-    def test_my_hostnames_basic(self, mock_fqdn, mock_uname):
+    def test_my_hostnames_basic(self, mock_fqdn, mock_uname, _mock_config):
         """Verify that utils.my_hostnames() returns what we expect."""
         hostname, fqdn = utils.my_hostnames()
         self.assertEqual(hostname, "foohost")
         self.assertEqual(fqdn, "foohost.dom")
+        utils.my_hostnames()
+        mock_fqdn.assert_called_once_with()
+
+    @patch("utils.config", return_value=60)
+    @patch("utils.os.uname", return_value=["Linux", "foohost"])
+    @patch("utils.socket.getfqdn", return_value="foohost.dom")
+    def test_lookup_fqdn_ttl(self, mock_fqdn, mock_uname, _mock_config):
+        """Verify that the fqdn is cached in unitdata for identity-cache-ttl."""
+        with tempfile.TemporaryDirectory() as tmp:
+            db = unitdata.Storage(os.path.join(tmp, "unit-state.db"))
+            with patch("utils.unitdata.kv", return_value=db):
+                self.assertEqual(utils.lookup_fqdn(), "foohost.dom")
+                self.assertEqual(utils.lookup_fqdn(), "foohost.dom")
+                mock_fqdn.assert_called_once_with()
+                mock_uname.return_value = ["Linux", "barhost"]
+                utils.lookup_fqdn()
+                self.assertEqual(mock_fqdn.call_count, 2)
+                with patch("utils.time.time", return_value=time.time() + 61):
+                    utils.lookup_fqdn()
+                self.assertEqual(mock_fqdn.call_count, 3)
+            db.close()
 
     @patch("utils.relation_ids")
     @patch("utils.related_units")
@@ -99,25 +132,446 @@ class TestUserdirLdap(unittest.TestCase):
             self.assertEqual(privkey_back, inputkey)
             self.assertRegex(pubkey_back, "^ssh-rsa ")
 
-    def test_cronsplay(self):
-        """Test utils.cronsplay()."""
-        # >>> binascii.crc_hqx(b"foobar", 0)
-        # 45093
-        cron_times = utils.cronsplay("foobar", interval=10)
-        self.assertEqual(cron_times, "3,13,23,33,43,53")
+    @patch("utils.status_set")
+    @patch("utils.subprocess.check_output")
+    def test_update_ssh_known_hosts(self, mock_check_output, mock_status_set):
+        """Test that known_hosts entries are replaced and only written if changed."""
+        ssh_dir = self.tmp / "ssh"
+        ssh_dir.mkdir()
+        known_hosts = ssh_dir / "known_hosts"
+        known_hosts.write_text(
+            "userdb.internal ssh-rsa OLD\nother ssh-rsa OTHER\n10.0.0.1 ssh-rsa OLD\n"
+        )
+        check_output(["ssh-keygen", "-H", "-f", str(known_hosts)], stderr=DEVNULL)
+        mock_check_output.side_effect = lambda cmd, **kwargs: (
+            "# {0}:22 SSH-2.0\n{0} ssh-rsa NEW\n".format(cmd[-1])
+            if cmd[-1] != "down"
+            else ""
+        )
+        hosts = ["userdb.internal", "10.0.0.1"]
+        utils.update_ssh_known_hosts(hosts, ssh_dir=str(ssh_dir))
+        lines = known_hosts.read_text().splitlines()
+        self.assertEqual(
+            lines[1:], ["userdb.internal ssh-rsa NEW", "10.0.0.1 ssh-rsa NEW"]
+        )
+        self.assertTrue(utils.known_host_matches(lines[0], "other"))
+        mock_status_set.assert_called_with("active", "")
+        mtime = known_hosts.stat().st_mtime_ns
+        utils.update_ssh_known_hosts(hosts + ["down"], ssh_dir=str(ssh_dir))
+        self.assertEqual(known_hosts.stat().st_mtime_ns, mtime)
+        mock_status_set.assert_called_with(
+            "blocked", "Provided userdb-ip is unreachable."
+        )
+        self.assertFalse(
+            utils.add_known_hosts(["10.0.0.1  ssh-rsa NEW"], ssh_dir=str(ssh_dir))
+        )
+
+    def test_cronschedule(self):
+        """Test that utils.cronschedule() spreads jobs at seconds granularity."""
+        minutes, delay = utils.cronschedule("foobar", interval=15)
+        first = int(minutes.split(",")[0])
+        self.assertEqual(minutes, ",".join(str(m) for m in range(first, 60, 15)))
+        self.assertLess(delay, 60)
+        offset = first * 60 + delay
+        minutes, delay = utils.cronschedule("foobar", interval=15, phase=0.5)
+        self.assertEqual((int(minutes.split(",")[0]) * 60 + delay - offset) % 900, 450)
+        offsets = {
+            utils.cronschedule("unit/{}".format(i), interval=15) for i in range(100)
+        }
+        self.assertGreater(len(offsets), 90)
+
+    @patch("utils.config")
+    def test_udldap_job_cmd(self, mock_config):
+        """Test wrapping cron jobs with udldap_job.py."""
+        mock_config.return_value = ""
+        self.assertEqual(
+            utils.udldap_job_cmd("ud-replicate", "/usr/bin/ud-replicate"),
+            "/usr/local/sbin/udldap_job.py --name ud-replicate -- "
+            "/usr/bin/ud-replicate",
+        )
+        mock_config.return_value = "/var/lib/node-exporter"
+        self.assertIn(
+            "--metrics-dir /var/lib/node-exporter --",
+            utils.udldap_job_cmd("ud-replicate", "/usr/bin/ud-replicate"),
+        )
+        self.assertIn(
+            "--coalesce --backoff 900 --",
+            utils.udldap_job_cmd("job", "/bin/true", coalesce=True, backoff=900),
+        )
+
+    @patch("utils.config")
+    def test_replicate_cmd(self, mock_config):
+        """Test that the nscd caches are invalidated after ud-replicate."""
+        mock_config.return_value = False
+        self.assertEqual(utils.replicate_cmd(), ["/usr/bin/ud-replicate"])
+        mock_config.side_effect = lambda key: key == "nscd"
+        self.assertEqual(
+            utils.replicate_cmd(),
+            [
+                "sh",
+                "-c",
+                "/usr/bin/ud-replicate || exit; "
+                "/usr/sbin/nscd -i passwd; /usr/sbin/nscd -i group; exit 0",
+            ],
+        )
+        # The shell command stays one argument in the cron line
+        self.assertIn(
+            " sh -c '/usr/bin/ud-replicate || exit; /usr/sbin/nscd -i passwd;"
+            " /usr/sbin/nscd -i group; exit 0'",
+            utils.udldap_job_cmd("ud-replicate", utils.replicate_cmd()),
+        )
+
+    @patch("utils.os.chown")
+    @patch("utils.pwd.getpwnam")
+    @patch("utils.pwd.getpwall")
+    def test_migrate_user_keys(self, mock_getpwall, mock_getpwnam, _mock_chown):
+        """Test that only new or changed keyfiles are migrated."""
+        with tempfile.TemporaryDirectory() as tmp:
+            entries = {}
+            for name in ("foo", "bar", "nokeys", "ldap"):
+                home = os.path.join(tmp, name)
+                os.makedirs(os.path.join(home, ".ssh"))
+                entries[name] = struct_passwd((name, "x", 1000, 1000, "", home, ""))
+                if name != "nokeys":
+                    with open(os.path.join(home, ".ssh/authorized_keys"), "w") as fp:
+                        fp.write("ssh-rsa {}\n".format(name))
+            mock_getpwall.return_value = list(entries.values())[:3]
+            mock_getpwnam.side_effect = lambda name: {"ldap": entries["ldap"]}[name]
+            dst_keydir = os.path.join(tmp, "keys")
+            os.mkdir(dst_keydir)
+            users = ["foo", "bar", "nokeys", "ldap", "missing"]
+            result = utils.migrate_user_keys(users, dst_keydir)
+            self.assertEqual(result["migrated"], ["foo", "bar", "ldap"])
+            self.assertEqual(result["missing"], ["missing"])
+            self.assertEqual(result["no_keys"], ["nokeys"])
+            with open(os.path.join(tmp, "bar", ".ssh/authorized_keys"), "a") as fp:
+                fp.write("ssh-rsa new\n")
+            result = utils.migrate_user_keys(users, dst_keydir)
+            self.assertEqual(result["migrated"], ["bar"])
+            self.assertEqual(result["unchanged"], ["foo", "ldap"])
+            with open(os.path.join(dst_keydir, "bar")) as fp:
+                self.assertEqual(fp.read(), "ssh-rsa bar\nssh-rsa new\n")
+            self.assertEqual(sorted(os.listdir(dst_keydir)), ["bar", "foo", "ldap"])
+
+    @patch("utils.log")
+    def test_reconcile(self, _mock_log):
+        """Test that reconcile() only runs steps whose inputs changed."""
+        calls = []
+
+        def step(name, result=None):
+            return lambda: calls.append(name) or result
+
+        with tempfile.TemporaryDirectory() as tmp:
+            db = unitdata.Storage(os.path.join(tmp, "unit-state.db"))
+            with patch("utils.unitdata.kv", return_value=db):
+                steps = [("a", [1], step("a")), ("b", lambda: 2, step("b", False))]
+                self.assertEqual(utils.reconcile(steps), [])
+                self.assertEqual(utils.reconcile(steps), ["a"])
+                steps[0] = ("a", [3], step("a"))
+                self.assertEqual(utils.reconcile(steps), [])
+                self.assertEqual(utils.reconcile(steps, force=True), [])
+            db.close()
+        self.assertEqual(calls, ["a", "b", "b", "a", "b", "a", "b"])
+
+    @patch("utils.relation_get")
+    @patch("utils.related_units", return_value=["consumer/0", "consumer/1"])
+    @patch("utils.relation_ids", return_value=["udprovide:1"])
+    def test_udprovide_units(self, _mock_relation_ids, _mock_related, mock_get):
+        """Test that udprovide_units() reads each unit's data at once."""
+        mock_get.side_effect = [
+            {"pub_key": "key0", "template_host": "template"},
+            {"pub_key": "key1"},
+        ]
+        self.assertEqual(
+            utils.udprovide_units("producer"),
+            {("key0", "template"), ("key1", "producer")},
+        )
+        mock_get.assert_called_with(unit="consumer/1", rid="udprovide:1")
+
+    def test_rank_upstreams(self):
+        """Test that consumers are spread across upstreams deterministically."""
+        addresses = ["10.0.0.1", "10.0.0.2", "10.0.0.3"]
+        first = [
+            utils.rank_upstreams(addresses, "consumer/{}".format(i))[0]
+            for i in range(300)
+        ]
+        for address in addresses:
+            self.assertGreater(first.count(address), 50)
+        ranked = utils.rank_upstreams(addresses, "consumer/0")
+        self.assertEqual(
+            utils.rank_upstreams(reversed(addresses), "consumer/0"), ranked
+        )
+        self.assertEqual(
+            utils.rank_upstreams(addresses[:2], "consumer/0"),
+            [a for a in ranked if a != "10.0.0.3"],
+        )
+
+    @patch("utils.log")
+    @patch("utils.probe_upstream")
+    def test_select_upstream(self, mock_probe, _mock_log):
+        """Test that select_upstream() fails over to reachable upstreams."""
+        addresses = ["10.0.0.1", "10.0.0.2", "10.0.0.3"]
+        ranked = utils.rank_upstreams(addresses, "consumer/0")
+        latencies = {ranked[0]: None, ranked[1]: 0.1, ranked[2]: 0.01}
+        mock_probe.side_effect = latencies.get
+        self.assertEqual(
+            utils.select_upstream(addresses, "consumer/0"), (ranked[1], 0.1)
+        )
+        latencies[ranked[1]] = 1.5
+        self.assertEqual(
+            utils.select_upstream(addresses, "consumer/0"), (ranked[2], 0.01)
+        )
+        # Slow upstreams are picked in rank order, not by latency
+        latencies[ranked[2]] = 0.9
+        self.assertEqual(
+            utils.select_upstream(addresses, "consumer/0"), (ranked[1], 1.5)
+        )
+        # unless the current one is still reachable
+        self.assertEqual(
+            utils.select_upstream(addresses, "consumer/0", ranked[2]),
+            (ranked[2], 0.9),
+        )
+        latencies[ranked[2]] = None
+        self.assertEqual(
+            utils.select_upstream(addresses, "consumer/0", ranked[2]),
+            (ranked[1], 1.5),
+        )
+        latencies[ranked[1]] = None
+        self.assertEqual(
+            utils.select_upstream(addresses, "consumer/0"), (ranked[0], None)
+        )
+
+    @patch("utils.log")
+    @patch("utils.probe_upstream")
+    def test_select_upstream_hysteresis(self, mock_probe, _mock_log):
+        """Test that select_upstream() doesn't flap around max_latency."""
+        addresses = ["10.0.0.1", "10.0.0.2", "10.0.0.3"]
+        ranked = utils.rank_upstreams(addresses, "consumer/0")
+        latencies = {ranked[0]: 0.45, ranked[1]: 0.05, ranked[2]: 0.05}
+        mock_probe.side_effect = latencies.get
+        self.assertEqual(
+            utils.select_upstream(addresses, "consumer/0", ranked[0]),
+            (ranked[0], 0.45),
+        )
+        latencies[ranked[0]] = 0.55
+        self.assertEqual(
+            utils.select_upstream(addresses, "consumer/0", ranked[0]),
+            (ranked[1], 0.05),
+        )
+        # Back within max_latency, but not clearly fast
+        latencies[ranked[0]] = 0.45
+        self.assertEqual(
+            utils.select_upstream(addresses, "consumer/0", ranked[1]),
+            (ranked[1], 0.05),
+        )
+        latencies[ranked[0]] = 0.1
+        self.assertEqual(
+            utils.select_upstream(addresses, "consumer/0", ranked[1]),
+            (ranked[0], 0.1),
+        )
+        # The current one is kept while within max_latency
+        latencies[ranked[0]] = None
+        latencies[ranked[1]] = 0.45
+        self.assertEqual(
+            utils.select_upstream(addresses, "consumer/0", ranked[1]),
+            (ranked[1], 0.45),
+        )
+
+    @patch("utils.config", return_value="")
+    @patch("utils.subprocess.check_call")
+    def test_queue_rsync_userdata(self, mock_check_call, _mock_config):
+        """Test that rsync_userdata.py runs are queued in a transient unit."""
+        utils.queue_rsync_userdata()
+        cmd = mock_check_call.call_args[0][0]
+        self.assertEqual(cmd[0], "systemd-run")
+        self.assertIn("--coalesce", cmd)
+        self.assertEqual(cmd[-2:], ["--config", utils.RSYNC_USERDATA_CFG])
+
+    def test_job_running(self):
+        """Test that job_running() goes by the pid in the job state."""
+        state_file = os.path.join(self.tmp, "udldap_job_{}.state")
+        dead = Popen(["true"])
+        dead.wait()
+        with patch("utils.UDLDAP_JOB_STATE", new=state_file):
+            self.assertFalse(utils.job_running("ud-replicate"))
+            for pid, running in ((os.getpid(), True), (dead.pid, False)):
+                with open(state_file.format("ud-replicate"), "w") as fp:
+                    json.dump({"running": pid}, fp)
+                self.assertEqual(utils.job_running("ud-replicate"), running)
+
+    @patch("utils.config", return_value="")
+    @patch("utils.status_set")
+    @patch("utils.subprocess.check_call")
+    def test_start_replicate(self, mock_check_call, mock_status_set, _mock_config):
+        """Test running ud-replicate in the background with a bounded wait."""
+        state_file = os.path.join(self.tmp, "udldap_job_{}.state")
+
+        def finish(returncode):
+            with open(state_file.format("ud-replicate"), "w") as fp:
+                json.dump(
+                    {
+                        "last_run": time.time(),
+                        "returncode": returncode,
+                        "failures": int(returncode != 0),
+                    },
+                    fp,
+                )
+
+        with patch("utils.UDLDAP_JOB_STATE", new=state_file):
+            self.assertIsNone(utils.start_replicate(wait=0))
+            self.assertEqual(mock_check_call.call_args[0][0][0], "systemd-run")
+            mock_status_set.assert_called_with("maintenance", "ud-replicate running")
+            mock_check_call.side_effect = lambda cmd: finish(0)
+            self.assertTrue(utils.start_replicate(wait=10))
+            mock_status_set.assert_called_with("active", "")
+            self.assertTrue(utils.replicate_succeeded())
+            mock_check_call.side_effect = lambda cmd: finish(1)
+            self.assertFalse(utils.start_replicate(wait=10))
+            self.assertFalse(utils.replicate_succeeded())
+            mock_status_set.assert_called_with(
+                "blocked", "ud-replicate failed 1 times in a row"
+            )
 
     @patch("utils.config")
     @patch("os.uname")
     def test_update_hosts(self, mock_uname, mock_config):
         """Test utils.update_hosts()."""
-        mock_config.return_value = "foodom"
+        mock_config.side_effect = lambda key: {"identity-cache-ttl": 60}.get(
+            key, "foodom"
+        )
         mock_uname.return_value = ["dummy", "existing"]
-        with patch("utils.HOSTS_FILE", new=str(self.hosts_file)):
-            utils.update_hosts("userdb.internal", "10.0.0.1")
+        with tempfile.TemporaryDirectory() as tmp:
+            db = unitdata.Storage(os.path.join(tmp, "unit-state.db"))
+            with patch("utils.HOSTS_FILE", new=str(self.hosts_file)), patch(
+                "utils.unitdata.kv", return_value=db
+            ):
+                utils.update_hosts("userdb.internal", "10.0.0.1")
         with self.hosts_file.open() as f:
             hosts = f.read()
             self.assertTrue(hosts.find("10.0.0.1") != -1)
 
+    @patch("utils.service_running", return_value=True)
+    @patch("utils.service_restart")
+    @patch("utils.service_resume")
+    @patch("utils.subprocess.check_call")
+    @patch("utils.write_file")
+    def test_setup_rsync_userdata_service(
+        self, mock_write_file, mock_check_call, mock_resume, mock_restart, _running
+    ):
+        """Test that the rsync_userdata service replaces the cron job."""
+        with tempfile.TemporaryDirectory() as tmp:
+            unit_file = os.path.join(tmp, "rsync-userdata.service")
+            cron_file = os.path.join(tmp, "rsync_userdata")
+            open(cron_file, "w").close()
+            with patch("utils.RSYNC_USERDATA_UNIT", new=unit_file), patch(
+                "utils.RSYNC_USERDATA_CRON", new=cron_file
+            ):
+                self.assertTrue(utils.setup_rsync_userdata_service())
+                self.assertFalse(os.path.exists(cron_file))
+                content = mock_write_file.call_args[1]["content"]
+                with open(unit_file, "w") as fp:
+                    fp.write(content)
+                # Unchanged and running, a trigger is safe
+                self.assertFalse(utils.setup_rsync_userdata_service())
+        self.assertIn("--daemon --config /var/lib/misc/rsync_userdata.cfg", content)
+        mock_check_call.assert_called_once_with(["systemctl", "daemon-reload"])
+        mock_resume.assert_called_with("rsync-userdata")
+        mock_restart.assert_called_once_with("rsync-userdata")
+
+    @patch("hooks.config", return_value=False)
+    @patch("hooks.setup_rsync_userdata", return_value=False)
+    @patch("hooks.mkdir")
+    @patch("hooks.relation_get", return_value={})
+    @patch("utils.queue_rsync_userdata")
+    @patch("utils.write_rsync_cfg")
+    @patch("utils.write_authkeys")
+    @patch("utils.ensure_user")
+    @patch("utils.udprovide_units")
+    @patch("utils.my_hostnames", return_value=("foo", "foo.dom"))
+    def test_udprovide_rel(
+        self,
+        _mock_my_hostnames,
+        mock_udprovide_units,
+        _mock_ensure_user,
+        mock_write_authkeys,
+        _mock_write_rsync_cfg,
+        mock_queue,
+        *_mocks
+    ):
+        """Test that udprovide_rel() only acts when the consumers changed."""
+        ud_units = {("ssh-rsa AAAA root@a", "a.internal")}
+        mock_udprovide_units.return_value = ud_units
+        with tempfile.TemporaryDirectory() as tmp:
+            db = unitdata.Storage(os.path.join(tmp, "unit-state.db"))
+            rsync_cfg = os.path.join(tmp, "rsync_userdata.cfg")
+            open(rsync_cfg, "w").close()
+            with patch("hooks.unitdata.kv", return_value=db), patch(
+                "utils.RSYNC_USERDATA_CFG", new=rsync_cfg
+            ):
+                hooks.udprovide_rel()
+                mock_write_authkeys.reset_mock()
+                mock_queue.reset_mock()
+                hooks.udprovide_rel()
+                mock_write_authkeys.assert_not_called()
+                mock_queue.assert_not_called()
+                ud_units.add(("ssh-rsa BBBB root@b", "b.internal"))
+                hooks.udprovide_rel()
+        mock_write_authkeys.assert_called_once_with("sshdist", ud_units)
+        mock_queue.assert_called_once_with()
+
+    @patch("utils.log")
+    @patch("utils.subprocess.check_output")
+    def test_update_sshd_config(self, mock_check_output, mock_log):
+        """Test that sshd config changes are validated and diffed semantically."""
+        with tempfile.TemporaryDirectory() as tmp:
+            dropin = os.path.join(tmp, "dropin.conf")
+            with open(dropin, "w") as fp:
+                fp.write("Ciphers fromdropin\n")
+            sshd_config = os.path.join(tmp, "sshd_config")
+            with open(sshd_config, "w") as fp:
+                fp.write(
+                    "Include {}\nHostKey /etc/ssh/ssh_host_dsa_key\nMACs=old\n"
+                    "Match User foo\n  MACs other\n".format(dropin)
+                )
+            conf = {"Ciphers": "aes", "MACs": "new", "KexAlgorithms": "curve"}
+            changed = utils.update_sshd_config(
+                conf, ["/etc/ssh/ssh_host_dsa_key"], path=sshd_config
+            )
+            self.assertEqual(changed, ["hostkey", "kexalgorithms", "macs"])
+            mock_check_output.assert_called_once_with(
+                ["/usr/sbin/sshd", "-t", "-f", sshd_config + ".new"],
+                stderr=utils.subprocess.STDOUT,
+            )
+            with open(sshd_config) as fp:
+                self.assertEqual(
+                    fp.read(),
+                    "Include {}\n#HostKey /etc/ssh/ssh_host_dsa_key\nMACs new\n"
+                    "Ciphers aes\nKexAlgorithms curve\nMatch User foo\n"
+                    "  MACs other\n".format(dropin),
+                )
+            self.assertIn("overridden", mock_log.call_args[0][0])
+            self.assertEqual(utils.update_sshd_config(conf, path=sshd_config), [])
+            mock_check_output.side_effect = CalledProcessError(255, "sshd")
+            with self.assertRaises(utils.UserdirLdapError):
+                utils.update_sshd_config({"MACs": "bad"}, path=sshd_config)
+            self.assertFalse(os.path.exists(sshd_config + ".new"))
+
+    @patch("utils.service_reload")
+    @patch("utils.atexit")
+    def test_schedule_sshd_reload(self, mock_atexit, mock_service_reload):
+        """Test that sshd is reloaded once per hook."""
+        with tempfile.TemporaryDirectory() as tmp:
+            db = unitdata.Storage(os.path.join(tmp, "unit-state.db"))
+            with patch("utils.unitdata.kv", return_value=db):
+                utils.schedule_sshd_reload()
+                utils.schedule_sshd_reload()
+                mock_atexit.assert_called_once_with(utils.reload_sshd)
+                self.assertTrue(db.get("sshd.reload_pending"))
+                utils.reload_sshd()
+                mock_service_reload.assert_called_once_with("ssh")
+                self.assertIsNone(db.get("sshd.reload_pending"))
+            db.close()
+
     def test_install_sudoer_group(self):
         """Test sudoer configuration."""
         with tempfile.NamedTemporaryFile() as tmp_file: